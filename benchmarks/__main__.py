@@ -0,0 +1,135 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+
+    Copyright 2017 Nick Badger.
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+'''
+
+import argparse
+import json
+import sys
+
+from .suite import run
+from .suite import compare
+from .suite import environment
+
+
+root_parser = argparse.ArgumentParser(
+    prog = 'python -m benchmarks',
+    description = 'Benchmark the asset model, and every route of the app.'
+)
+root_parser.add_argument(
+    '--sizes', '-s',
+    action = 'store',
+    type = str,
+    default = '1000,100000,1000000',
+    help = 'Comma-separated database sizes (in assets) to run the route ' +
+           'benchmarks against. Defaults to 1000,100000,1000000.'
+)
+root_parser.add_argument(
+    '--repeat', '-r',
+    action = 'store',
+    type = int,
+    default = 3,
+    help = 'How many runs to take the best of. Defaults to 3.'
+)
+root_parser.add_argument(
+    '--select', '-k',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Only run the benchmarks with this in their name.'
+)
+root_parser.add_argument(
+    '--output', '-o',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Write the results to this json file.'
+)
+root_parser.add_argument(
+    '--compare', '-c',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Compare the results against an earlier json results file, and ' +
+           'exit with an error if anything regressed.'
+)
+root_parser.add_argument(
+    '--threshold', '-t',
+    action = 'store',
+    type = float,
+    default = .1,
+    help = 'How much slower (as a fraction) counts as a regression. ' +
+           'Defaults to .1 (10%%).'
+)
+
+
+def log(result):
+    size = '-' if result['size'] is None else result['size']
+    print('%-55s %9s %12.2f us/op %12.0f ops/s' % (
+        result['benchmark'], size, result['seconds_per_op'] * 1e6,
+        result['ops_per_second']))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    args = root_parser.parse_args()
+    
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size]
+    except ValueError:
+        root_parser.error('--sizes must be comma-separated integers')
+    
+    # Load this first, so a typo doesn't cost a whole run
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+    
+    new = {
+        'environment': environment(),
+        'results': run(sizes, args.repeat, args.select, log),
+    }
+    
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(new, f, indent=2, sort_keys=True)
+    
+    if args.compare is not None:
+        regressions = 0
+        print('\nCompared to %s:' % args.compare)
+        for label, size, before, after, regressed in compare(
+                old, new, args.threshold):
+            regressions += regressed
+            print('%-55s %9s %+8.1f%%%s' % (
+                label, '-' if size is None else size,
+                (after / before - 1) * 100, '  REGRESSED' if regressed else ''))
+        
+        if regressions:
+            sys.exit(1)
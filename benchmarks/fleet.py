@@ -0,0 +1,205 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+
+    Copyright 2017 Nick Badger.
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+'''
+
+import argparse
+import os
+import random
+
+import plassets
+from plassets import Asset
+from plassets.plassets import dump_details
+from plassets.plassets import rebuild_asset_counts
+
+
+root_parser = argparse.ArgumentParser(
+    prog = 'python -m benchmarks.fleet',
+    description = 'Populate a plassets database with a synthetic fleet.'
+)
+root_parser.add_argument(
+    'database',
+    action = 'store',
+    type = str,
+    help = 'Path to the sqlite database to add the fleet to (created if ' +
+           'it does not exist).'
+)
+root_parser.add_argument(
+    '--count', '-n',
+    action = 'store',
+    type = int,
+    default = 1000000,
+    help = 'How many assets to add. Defaults to 1000000.'
+)
+root_parser.add_argument(
+    '--mix', '-m',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Relative weights of the asset classes, as class=weight,... ' +
+           'Defaults to dove=50,rapideye=5,dish=15,yagi=30.'
+)
+root_parser.add_argument(
+    '--seed',
+    action = 'store',
+    type = int,
+    default = 0,
+    help = 'Random seed, so fleets are reproducible. Defaults to 0.'
+)
+
+
+# Roughly what a real fleet looks like: lots of doves and yagis, a few
+# rapideyes
+DEFAULT_MIX = {'dove': 50, 'rapideye': 5, 'dish': 15, 'yagi': 30}
+# Each class gets its own naming scheme, like a real fleet would
+NAME_PREFIXES = {
+    'dove': ['dove', 'flock1', 'flock2', 'flock3', 'flock4'],
+    'rapideye': ['re', 'rapideye'],
+    'dish': ['gs-dish', 'svalbard', 'awarua', 'fairbanks', 'dish'],
+    'yagi': ['yagi', 'ham', 'uhf', 'vhf'],
+}
+# Rows per executemany
+INSERT_CHUNK = 10000
+
+
+def parse_mix(spec):
+    ''' Parse a --mix spec (class=weight,...) into a dict. Raises
+    ValueError for unknown classes or bad weights.
+    '''
+    mix = {}
+    for item in spec.split(','):
+        asset_class, __, weight = item.partition('=')
+        if asset_class not in NAME_PREFIXES:
+            raise ValueError(asset_class)
+        mix[asset_class] = float(weight)
+    
+    if not mix or any(weight < 0 for weight in mix.values()) or \
+            not sum(mix.values()):
+        raise ValueError(spec)
+    return mix
+
+
+def random_details(rand, asset_class):
+    ''' Random details for an asset of asset_class. Like real ones, they
+    aren't always all filled in.
+    '''
+    details = {}
+    
+    if asset_class == 'dish':
+        if rand.random() < .9:
+            details['diameter'] = round(rand.lognormvariate(1.5, .6), 2)
+        if rand.random() < .8:
+            details['radome'] = rand.random() < .3
+    
+    elif asset_class == 'yagi':
+        if rand.random() < .9:
+            details['gain'] = round(rand.uniform(3, 20), 1)
+    
+    return details
+
+
+def generate(count, mix=None, seed=0):
+    ''' Yield count random (name, type, class, details) assets, with
+    unique names matching NAME_PATTERN, in random name order.
+    '''
+    mix = DEFAULT_MIX if mix is None else mix
+    rand = random.Random(seed)
+    classes = sorted(mix)
+    weights = [mix[asset_class] for asset_class in classes]
+    types = {asset_class: asset_type
+             for asset_type, asset_classes in Asset.VALID_CLASSES.items()
+             for asset_class in asset_classes}
+    names = set()
+    
+    while len(names) < count:
+        asset_class = rand.choices(classes, weights)[0]
+        width = rand.choice([4, 6, 8, 12])
+        name = '%s-%0*x' % (rand.choice(NAME_PREFIXES[asset_class]), width,
+                            rand.getrandbits(4 * width))
+        if name in names:
+            continue
+        
+        names.add(name)
+        yield (name, types[asset_class], asset_class,
+               random_details(rand, asset_class))
+
+
+def populate(count, mix=None, seed=0):
+    ''' Bulk insert a generated fleet straight into the app's database,
+    bypassing the api (and the session), in a single transaction. The
+    schema must already be there (see plassets.upgrade_db). Returns the
+    names, in the order they were generated.
+    '''
+    table = Asset.__table__
+    names = []
+    rows = []
+    
+    with plassets.db.get_engine().begin() as conn:
+        for name, asset_type, asset_class, details in generate(count, mix,
+                                                                seed):
+            names.append(name)
+            rows.append({
+                'name': name,
+                'type': asset_type,
+                'class': asset_class,
+                'details': dump_details(details) if details else None
+            })
+            
+            if len(rows) >= INSERT_CHUNK:
+                conn.execute(table.insert(), rows)
+                rows = []
+        
+        if rows:
+            conn.execute(table.insert(), rows)
+    
+    rebuild_asset_counts()
+    return names
+
+
+if __name__ == '__main__':
+    args = root_parser.parse_args()
+    
+    try:
+        mix = None if args.mix is None else parse_mix(args.mix)
+    except ValueError:
+        root_parser.error('bad --mix: ' + args.mix)
+    
+    plassets.create_app(
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' +
+                                  os.path.abspath(args.database),
+        SQLALCHEMY_TRACK_MODIFICATIONS = False,
+        PLASSETS_SQLITE_PRAGMAS = plassets.SQLITE_PROFILES['balanced']
+    )
+    plassets.upgrade_db()
+    
+    names = populate(args.count, mix, args.seed)
+    plassets.db.get_engine().dispose()
+    print('Added %d assets to %s' % (len(names), args.database))
@@ -0,0 +1,450 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+
+    Copyright 2017 Nick Badger.
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+'''
+
+import argparse
+import collections
+import json
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+except ImportError:
+    import httplib
+    from urlparse import urlsplit
+
+from plassets.plassets import encode_cursor
+
+from .fleet import random_details
+
+
+# The kinds of requests to mix, and their default weights
+DEFAULT_MIX = collections.OrderedDict([
+    ('get', 60),
+    ('list', 10),
+    ('filter', 20),
+    ('stats', 5),
+    ('create', 4),
+    ('bulk', 1),
+])
+# Filtered listings to pick from for filter requests
+FILTERS = [
+    '/assets/v1/sat',
+    '/assets/v1/sat/dove',
+    '/assets/v1/sat/rapideye',
+    '/assets/v1/ant/',
+    '/assets/v1/ant/dish',
+    '/assets/v1/ant/yagi',
+    '/assets/v1/?class=dish&diameter__gt=10.0',
+    '/assets/v1/?class=yagi&gain__lte=6.0',
+    '/assets/v1/?type=satellite&fields=name',
+]
+# How many existing names to sample for get requests (and list cursors)
+NAME_SAMPLE = 10000
+# The size of each bulk create
+BULK_SIZE = 100
+# How long to wait for a --spawn server to come up, in seconds
+SPAWN_TIMEOUT = 30
+
+
+root_parser = argparse.ArgumentParser(
+    prog = 'python -m benchmarks.load',
+    description = 'Drive concurrent load against a plassets server, and ' +
+                  'report throughput and latency per kind of request.'
+)
+root_parser.add_argument(
+    '--url', '-u',
+    action = 'store',
+    type = str,
+    default = 'http://127.0.0.1:8080',
+    help = 'Where the server is. Defaults to http://127.0.0.1:8080.'
+)
+root_parser.add_argument(
+    '--clients', '-c',
+    action = 'store',
+    type = int,
+    default = 16,
+    help = 'How many concurrent clients (threads) to run. Defaults to 16.'
+)
+root_parser.add_argument(
+    '--duration', '-d',
+    action = 'store',
+    type = float,
+    default = 30,
+    help = 'How long to run for, in seconds. Defaults to 30.'
+)
+root_parser.add_argument(
+    '--mix', '-m',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Relative weights of the kinds of requests, as kind=weight,... ' +
+           'Kinds are ' + ', '.join(DEFAULT_MIX) + '. Defaults to ' +
+           ','.join('%s=%d' % item for item in DEFAULT_MIX.items()) + '.'
+)
+root_parser.add_argument(
+    '--limit', '-l',
+    action = 'store',
+    type = int,
+    default = 100,
+    help = 'Page size for list and filter requests. Defaults to 100.'
+)
+root_parser.add_argument(
+    '--seed',
+    action = 'store',
+    type = int,
+    default = 0,
+    help = 'Random seed. Defaults to 0.'
+)
+root_parser.add_argument(
+    '--output', '-o',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Write the report to this json file.'
+)
+root_parser.add_argument(
+    '--spawn',
+    action = 'store',
+    type = str,
+    default = None,
+    metavar = 'DATABASE',
+    help = 'Start a python -m plassets server on this database (at the ' +
+           'host and port of --url) for the run, instead of using an ' +
+           'already-running one. See benchmarks.fleet to populate it.'
+)
+root_parser.add_argument(
+    '--server-args',
+    action = 'store',
+    type = str,
+    default = '',
+    help = 'Extra arguments for the --spawn server, ex "--workers 8".'
+)
+
+
+def parse_mix(spec):
+    ''' Parse a --mix spec (kind=weight,...) into a dict. Raises
+    ValueError for unknown kinds or bad weights.
+    '''
+    mix = collections.OrderedDict()
+    for item in spec.split(','):
+        kind, __, weight = item.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise ValueError(kind)
+        mix[kind] = float(weight)
+    
+    if any(weight < 0 for weight in mix.values()) or not sum(mix.values()):
+        raise ValueError(spec)
+    return mix
+
+
+def percentile(ordered, fraction):
+    ''' Nearest-rank percentile of an already-sorted list.
+    '''
+    if not ordered:
+        return None
+    index = int(round(fraction * len(ordered) + .5)) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+class LoadClient(object):
+    ''' One simulated client, with its own keep-alive connection. Call
+    request(kind) for a request of one of the kinds in DEFAULT_MIX.
+    '''
+    
+    def __init__(self, url, names, limit, seed, prefix):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.names = names
+        self.limit = limit
+        self.rand = random.Random(seed)
+        # For the names of new assets, which have to be unique
+        self.prefix = prefix
+        self.created = 0
+        self.conn = None
+    
+    def send(self, method, path, body=None, headers=None):
+        ''' Make a single request, returning the status and body.
+        Reconnects after connection errors (but still raises them).
+        '''
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.host, self.port,
+                                               timeout=60)
+        
+        try:
+            self.conn.request(method, path, body, headers or {})
+            response = self.conn.getresponse()
+            body = response.read()
+        
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            raise
+        
+        return response.status, body
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    def new_asset(self):
+        asset_class = self.rand.choice(['dove', 'rapideye', 'dish', 'yagi'])
+        self.created += 1
+        return {
+            'name': '%s-%d' % (self.prefix, self.created),
+            'type': 'antenna' if asset_class in ('dish', 'yagi') else
+                    'satellite',
+            'class': asset_class,
+            'details': random_details(self.rand, asset_class)
+        }
+    
+    def request(self, kind):
+        ''' Make a request of the passed kind, returning the status.
+        '''
+        limit = 'limit=%d' % self.limit
+        
+        if kind == 'get':
+            path = '/assets/v1/' + self.rand.choice(self.names)
+            status, __ = self.send('GET', path)
+        
+        elif kind == 'list':
+            # Half first pages, half pages from somewhere in the middle
+            path = '/assets/v1/?' + limit
+            if self.rand.random() < .5:
+                path += '&cursor=' + encode_cursor(
+                    self.rand.choice(self.names))
+            status, __ = self.send('GET', path)
+        
+        elif kind == 'filter':
+            path = self.rand.choice(FILTERS)
+            path += ('&' if '?' in path else '?') + limit
+            status, __ = self.send('GET', path)
+        
+        elif kind == 'stats':
+            status, __ = self.send('GET', '/assets/v1/_stats')
+        
+        elif kind == 'create':
+            status, __ = self.send('POST', '/assets/v1/',
+                                   json.dumps(self.new_asset()),
+                                   {'X-User': 'admin'})
+        
+        elif kind == 'bulk':
+            assets = [self.new_asset() for __ in range(BULK_SIZE)]
+            status, __ = self.send('POST', '/assets/v1/_bulk',
+                                   json.dumps(assets), {'X-User': 'admin'})
+        
+        else:
+            raise ValueError(kind)
+        
+        return status
+
+
+def sample_names(url, count=NAME_SAMPLE, seed=0):
+    ''' Grab up to count existing asset names from the server, from pages
+    all over the store (instead of just the first ones).
+    '''
+    client = LoadClient(url, [], 1000, seed, None)
+    rand = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    names = set()
+    
+    try:
+        for __ in range(max(count // 1000, 1) * 2):
+            cursor = encode_cursor(''.join(rand.choice(alphabet)
+                                           for __ in range(3)))
+            status, body = client.send(
+                'GET', '/assets/v1/?fields=name&limit=1000&cursor=' + cursor)
+            if status != 200:
+                raise RuntimeError('Listing assets failed with %d' % status)
+            
+            names.update(item['name'] for item in
+                         json.loads(body.decode('utf-8')))
+            if len(names) >= count:
+                break
+    
+    finally:
+        client.close()
+    
+    return sorted(names)[:count]
+
+
+def run(url, clients, duration, mix, limit, seed):
+    ''' Run clients concurrent clients against the server at url for
+    duration seconds, making requests per the mix. Returns the report:
+    per kind of request (and in total), the number of requests and
+    errors, throughput, and latency percentiles.
+    '''
+    names = sample_names(url, seed=seed)
+    if not names and (mix.get('get') or mix.get('list')):
+        raise RuntimeError('There are no assets to get; populate the ' +
+                           'database first (see benchmarks.fleet).')
+    
+    kinds = [kind for kind in mix if mix[kind]]
+    weights = [mix[kind] for kind in kinds]
+    # Unique per run, so that creates never conflict with earlier runs
+    run_id = '%08x' % random.SystemRandom().getrandbits(32)
+    
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    start = timeit.default_timer()
+    deadline = start + duration
+    
+    def work(ident):
+        client = LoadClient(url, names, limit, seed + ident,
+                            'load-%s-%d' % (run_id, ident))
+        rand = random.Random(seed + ident)
+        my_latencies = collections.defaultdict(list)
+        my_errors = collections.Counter()
+        
+        while timeit.default_timer() < deadline:
+            kind = rand.choices(kinds, weights)[0]
+            before = timeit.default_timer()
+            try:
+                status = client.request(kind)
+            except (httplib.HTTPException, socket.error):
+                status = None
+            
+            if status == 200:
+                my_latencies[kind].append(timeit.default_timer() - before)
+            else:
+                my_errors[kind] += 1
+        
+        with lock:
+            for kind, values in my_latencies.items():
+                latencies[kind].extend(values)
+            errors.update(my_errors)
+    
+    threads = [threading.Thread(target=work, args=(ident,))
+               for ident in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - start
+    
+    report = collections.OrderedDict()
+    everything = []
+    for kind in kinds + ['total']:
+        if kind == 'total':
+            values = sorted(everything)
+            kind_errors = sum(errors.values())
+        else:
+            values = sorted(latencies[kind])
+            kind_errors = errors[kind]
+            everything.extend(values)
+        
+        report[kind] = {
+            'requests': len(values),
+            'errors': kind_errors,
+            'throughput': len(values) / elapsed,
+            'p50': percentile(values, .5),
+            'p95': percentile(values, .95),
+            'p99': percentile(values, .99),
+        }
+    
+    return report
+
+
+def spawn(database, url, server_args):
+    ''' Start python -m plassets on database, listening where url says,
+    and wait for it to come up. Returns the process.
+    '''
+    parts = urlsplit(url)
+    command = [sys.executable, '-m', 'plassets', '--database', database,
+               '--host', parts.hostname, '--port', str(parts.port or 80)]
+    command.extend(shlex.split(server_args))
+    process = subprocess.Popen(command)
+    
+    deadline = time.time() + SPAWN_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited with %d' % process.returncode)
+        
+        try:
+            conn = httplib.HTTPConnection(parts.hostname, parts.port or 80,
+                                          timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return process
+        
+        except (httplib.HTTPException, socket.error):
+            time.sleep(.1)
+    
+    process.terminate()
+    raise RuntimeError('Server did not come up')
+
+
+def log(report):
+    print('%-8s %10s %8s %10s %9s %9s %9s' % (
+        'kind', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for kind, stats in report.items():
+        print('%-8s %10d %8d %10.1f %9s %9s %9s' % ((
+            kind, stats['requests'], stats['errors'], stats['throughput']) +
+            tuple('-' if stats[key] is None else '%.2f' % (stats[key] * 1e3)
+                  for key in ('p50', 'p95', 'p99'))))
+
+
+if __name__ == '__main__':
+    args = root_parser.parse_args()
+    
+    try:
+        mix = DEFAULT_MIX if args.mix is None else parse_mix(args.mix)
+    except ValueError:
+        root_parser.error('bad --mix: ' + args.mix)
+    
+    server = None
+    if args.spawn is not None:
+        server = spawn(args.spawn, args.url, args.server_args)
+    
+    try:
+        report = run(args.url, args.clients, args.duration, mix, args.limit,
+                     args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    
+    log(report)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,282 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+
+    Copyright 2017 Nick Badger.
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+'''
+
+import itertools
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import timeit
+
+import flask
+import sqlalchemy
+from sqlalchemy.pool import QueuePool
+
+import plassets
+from plassets import Asset
+from plassets import SQLITE_PROFILES
+from plassets.plassets import encode_cursor
+
+from .fleet import populate
+from .validation import make_payloads
+
+
+# Every timing runs for at least this long, in seconds
+MIN_TIME = .2
+# How many assets the model benchmarks work on
+MODEL_COUNT = 10000
+# The size of each POST /assets/v1/_bulk request
+BULK_SIZE = 100
+
+
+def autorange(func, repeat):
+    ''' Time func, calling it enough times per run to take at least
+    MIN_TIME. Returns the best time per call over repeat runs, and the
+    number of calls per run.
+    '''
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2
+    
+    times = [elapsed]
+    if repeat > 1:
+        times.extend(timeit.repeat(func, number=number, repeat=repeat - 1))
+    return min(times) / number, number
+
+
+def make_app(db_path):
+    ''' Point the plassets app at a fresh database at db_path, set up
+    like a persistent one from python -m plassets.
+    '''
+    app = plassets.create_app(
+        TESTING = False,
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path,
+        SQLALCHEMY_TRACK_MODIFICATIONS = False,
+        SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': QueuePool},
+        PLASSETS_SQLITE_PRAGMAS = SQLITE_PROFILES['balanced']
+    )
+    plassets.upgrade_db()
+    return app
+
+
+def model_benchmarks():
+    ''' Yield (label, func, ops) for the model benchmarks, where each call
+    of func does ops operations.
+    '''
+    payloads = make_payloads(MODEL_COUNT)
+    assets = [Asset(name, asset_type, asset_class, **details)
+              for name, asset_type, asset_class, details in payloads]
+    dishes = [asset for asset in assets if asset.asset_class == 'dish']
+    
+    def construct():
+        for name, asset_type, asset_class, details in payloads:
+            Asset(name, asset_type, asset_class, **details)
+    
+    def dictify():
+        for asset in assets:
+            asset.dictify()
+    
+    def get_detail():
+        for asset in dishes:
+            asset.diameter
+    
+    def set_detail():
+        for asset in dishes:
+            asset.radome = True
+    
+    yield 'Asset()', construct, len(assets)
+    yield 'Asset.dictify', dictify, len(assets)
+    yield 'asset_detail get', get_detail, len(dishes)
+    yield 'asset_detail set', set_detail, len(dishes)
+
+
+def route_benchmarks(client, names):
+    ''' Yield (label, func, ops) for every route, through the test client,
+    against a database holding names.
+    '''
+    rand = random.Random(0)
+    some_names = itertools.cycle(rand.sample(names, min(len(names), 1000)))
+    deep_cursor = encode_cursor(sorted(names)[len(names) * 9 // 10])
+    new_names = ('bench-%08d' % ii for ii in itertools.count())
+    
+    def request(method, url, **kwargs):
+        response = client.open(url, method=method, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError('%s %s: %d' % (method, url,
+                                              response.status_code))
+        # Make sure streamed responses actually get generated
+        response.get_data()
+    
+    def get(url):
+        return lambda: request('GET', url)
+    
+    def get_single():
+        request('GET', '/assets/v1/' + next(some_names))
+    
+    def post_single():
+        data = {'name': next(new_names), 'type': 'antenna', 'class': 'dish',
+                'details': {'diameter': 5.0, 'radome': False}}
+        request('POST', '/assets/v1/', data=flask.json.dumps(data),
+                headers={'X-User': 'admin'})
+    
+    def post_bulk():
+        data = [{'name': next(new_names), 'type': 'satellite',
+                 'class': 'dove', 'details': {}} for __ in range(BULK_SIZE)]
+        request('POST', '/assets/v1/_bulk', data=flask.json.dumps(data),
+                headers={'X-User': 'admin'})
+    
+    yield 'GET /', get('/'), 1
+    yield 'GET /assets/v1/', get('/assets/v1/'), 1
+    yield 'GET /assets/v1/?stream=1', get('/assets/v1/?stream=1'), 1
+    yield ('GET /assets/v1/?limit=100', get('/assets/v1/?limit=100'), 1)
+    yield ('GET /assets/v1/?limit=100&cursor=(deep)',
+           get('/assets/v1/?limit=100&cursor=' + deep_cursor), 1)
+    yield ('GET /assets/v1/?fields=name&limit=100',
+           get('/assets/v1/?fields=name&limit=100'), 1)
+    yield 'GET /assets/v1/<name>', get_single, 1
+    yield 'GET /assets/v1/_stats', get('/assets/v1/_stats'), 1
+    
+    for url in ('/assets/v1/sat', '/assets/v1/sat/dove',
+                '/assets/v1/sat/rapideye', '/assets/v1/ant/',
+                '/assets/v1/ant/dish', '/assets/v1/ant/yagi',
+                '/assets/v1/?class=dish&diameter__gt=10.0'):
+        url += ('&' if '?' in url else '?') + 'limit=100'
+        yield 'GET ' + url, get(url), 1
+    
+    # These change the database, so they go last
+    yield 'POST /assets/v1/', post_single, 1
+    yield 'POST /assets/v1/_bulk', post_bulk, BULK_SIZE
+
+
+def run(sizes, repeat, selected=None, log=None):
+    ''' Run the whole suite: the model benchmarks once, and the route
+    benchmarks against a database of each of the sizes. Pass selected to
+    only run benchmarks with that in their label. Returns a list of
+    result dicts.
+    '''
+    results = []
+    
+    def record(label, func, ops, size):
+        if selected is not None and selected not in label:
+            return
+        
+        seconds, calls = autorange(func, repeat)
+        result = {
+            'benchmark': label,
+            'size': size,
+            'seconds_per_op': seconds / ops,
+            'ops_per_second': ops / seconds,
+            'calls': calls,
+        }
+        results.append(result)
+        if log is not None:
+            log(result)
+    
+    for label, func, ops in model_benchmarks():
+        record(label, func, ops, None)
+    
+    for size in sizes:
+        db_dir = tempfile.mkdtemp()
+        try:
+            app = make_app(os.path.join(db_dir, 'plassets.db'))
+            names = populate(size)
+            client = app.test_client()
+            
+            for label, func, ops in route_benchmarks(client, names):
+                record(label, func, ops, size)
+        
+        finally:
+            plassets.db.session.remove()
+            plassets.db.get_engine().dispose()
+            shutil.rmtree(db_dir)
+    
+    return results
+
+
+def git_revision():
+    ''' The current commit of the source checkout, if there is one.
+    '''
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    
+    return revision.decode('ascii').strip()
+
+
+def environment():
+    ''' Describe what the benchmarks ran on, so results can be compared
+    like with like.
+    '''
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'flask': flask.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+    }
+
+
+def compare(old, new, threshold):
+    ''' Compare two sets of results (as written by python -m benchmarks).
+    Returns a list of (benchmark, size, old seconds, new seconds,
+    regressed) for every benchmark in both, where regressed means the new
+    one is more than threshold (ex .1 for 10%) slower.
+    '''
+    old_results = {(result['benchmark'], result['size']): result
+                   for result in old['results']}
+    comparison = []
+    
+    for result in new['results']:
+        key = result['benchmark'], result['size']
+        if key not in old_results:
+            continue
+        
+        before = old_results[key]['seconds_per_op']
+        after = result['seconds_per_op']
+        comparison.append(key + (before, after,
+                                 after > before * (1 + threshold)))
+    
+    return comparison
@@ -0,0 +1,151 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+    
+    Copyright 2017 Nick Badger.
+    
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+'''
+
+import argparse
+import random
+import timeit
+
+from plassets import Asset
+from plassets import validate_asset
+from plassets.plassets import NAME_PATTERN
+from plassets.plassets import DETAILS
+from plassets.plassets import VALIDATORS
+
+
+root_parser = argparse.ArgumentParser(
+    description = 'Benchmark asset validation.'
+)
+root_parser.add_argument(
+    '--count', '-n',
+    action = 'store',
+    type = int,
+    default = 10000,
+    help = 'How many asset payloads to validate per run. Defaults to 10000.'
+)
+root_parser.add_argument(
+    '--repeat', '-r',
+    action = 'store',
+    type = int,
+    default = 5,
+    help = 'How many runs to take the best of. Defaults to 5.'
+)
+
+
+def make_payloads(count, seed=0):
+    ''' Make count valid (name, type, class, details) payloads, with a mix
+    of all of the asset types and classes.
+    '''
+    rand = random.Random(seed)
+    payloads = []
+    
+    for ii in range(count):
+        asset_class = rand.choice(['dove', 'rapideye', 'dish', 'yagi'])
+        if asset_class == 'dish':
+            details = {'diameter': rand.uniform(1, 20),
+                       'radome': rand.random() < .5}
+        elif asset_class == 'yagi':
+            details = {'gain': rand.uniform(5, 20)}
+        else:
+            details = {}
+        
+        asset_type = 'antenna' if asset_class in {'dish', 'yagi'} else \
+            'satellite'
+        payloads.append(('asset-%08d' % ii, asset_type, asset_class, details))
+    
+    return payloads
+
+
+def legacy_validate(name, asset_type, asset_class, details):
+    ''' The checks Asset used to make before there was a validator
+    registry, as a point of comparison.
+    '''
+    if not NAME_PATTERN.match(name):
+        raise ValueError(name)
+    if asset_type not in Asset.VALID_TYPES:
+        raise ValueError(asset_type)
+    if asset_class not in Asset.VALID_CLASSES[asset_type]:
+        raise ValueError(asset_class)
+    if any(key not in dir(Asset) for key in details):
+        raise AttributeError()
+    
+    for key, value in details.items():
+        spec = DETAILS[key]
+        if spec.asset_type != asset_type or spec.asset_class != asset_class:
+            raise AttributeError(key)
+        elif not isinstance(value, spec.cls):
+            raise TypeError(value)
+
+
+def lookup_only(name, asset_type, asset_class, details):
+    ''' The floor: just the validator lookup, without validating.
+    '''
+    VALIDATORS[asset_type, asset_class]
+
+
+def construct(name, asset_type, asset_class, details):
+    Asset(name, asset_type, asset_class, **details)
+
+
+CANDIDATES = [
+    ('dict lookup (floor)', lookup_only),
+    ('validate_asset', validate_asset),
+    ('legacy checks', legacy_validate),
+    ('Asset()', construct),
+]
+
+
+def run(count, repeat):
+    ''' Time every candidate over count payloads, and return a list of
+    (label, seconds per payload).
+    '''
+    payloads = make_payloads(count)
+    results = []
+    
+    for label, func in CANDIDATES:
+        def bench():
+            for payload in payloads:
+                func(*payload)
+        
+        best = min(timeit.repeat(bench, number=1, repeat=repeat))
+        results.append((label, best / count))
+    
+    return results
+
+
+if __name__ == '__main__':
+    args = root_parser.parse_args()
+    
+    print('Validating %d payloads (best of %d):' % (args.count, args.repeat))
+    for label, per_payload in run(args.count, args.repeat):
+        print('    %-22s %8.2f us/asset %12.0f assets/s' % (
+            label, per_payload * 1e6, 1 / per_payload))
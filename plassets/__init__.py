@@ -40,6 +40,19 @@ Plassets: Planet Labs asset store coding exercise
 from .plassets import app
 from .plassets import db
 from .plassets import Asset
+from .plassets import AssetCount
+from .plassets import upgrade_db
+from .plassets import snapshot_db
+from .plassets import restore_snapshot
+from .plassets import validate_asset
+from .plassets import init_asset_cache
+from .plassets import init_store_version
+from .plassets import init_shards
+from .plassets import init_readers
+from .plassets import init_sqlite_pragmas
+from .plassets import init_metrics
+from .plassets import init_query_accounting
+from .plassets import SQLITE_PROFILES
 
 
 # Logging shenanigans
@@ -50,7 +63,9 @@ logging.getLogger(__name__).addHandler(NullHandler())
 
 
 # Control * imports.
-__all__ = ['app', 'db', 'create_app', 'Asset']
+__all__ = ['app', 'db', 'create_app', 'upgrade_db', 'snapshot_db',
+           'restore_snapshot', 'validate_asset', 'Asset', 'AssetCount',
+           'SQLITE_PROFILES']
 
 
 def create_app(**config):
@@ -58,5 +73,12 @@ def create_app(**config):
         app.config[key] = value
     
     db.init_app(app)
+    init_asset_cache(app)
+    init_store_version(app)
+    init_shards(app)
+    init_readers(app)
+    init_sqlite_pragmas(app)
+    init_metrics(app)
+    init_query_accounting(app)
     app.app_context().push()
     return app
@@ -32,11 +32,31 @@ Plassets: Planet Labs asset store coding exercise
 '''
 
 import os
+import io
+import sys
+import time
+import timeit
+import signal
+import logging
 import tempfile
 import argparse
 
+from flask import _app_ctx_stack
+from sqlalchemy.pool import QueuePool
+
 from . import create_app
-from . import db
+from . import upgrade_db
+from . import snapshot_db
+from . import restore_snapshot
+from . import SQLITE_PROFILES
+from .plassets import shard_bind
+from .plassets import shard_path
+from .plassets import dispose_engines
+from .bulk import FORMATS
+from .bulk import IMPORT_TRANSACTION_SIZE
+from .bulk import guess_format
+from .bulk import import_assets
+from .bulk import export_assets
 
 
 root_parser = argparse.ArgumentParser()
@@ -54,21 +74,576 @@ root_parser.add_argument(
     default = 8080,
     help = 'What port to serve from. Defaults to 8080.'
 )
+root_parser.add_argument(
+    '--database', '-d',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Path to a persistent sqlite database, which will be created ' +
+           'if it does not exist. Defaults to a throwaway tempfile.'
+)
+root_parser.add_argument(
+    '--profile',
+    action = 'store',
+    choices = sorted(SQLITE_PROFILES),
+    default = None,
+    help = 'Sqlite durability/performance profile. Defaults to balanced ' +
+           'for persistent databases, and default otherwise.'
+)
+root_parser.add_argument(
+    '--journal-mode',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Override the journal_mode pragma of the profile.'
+)
+root_parser.add_argument(
+    '--synchronous',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Override the synchronous pragma of the profile.'
+)
+root_parser.add_argument(
+    '--cache-size',
+    action = 'store',
+    type = int,
+    default = None,
+    help = 'Override the cache_size pragma of the profile (pages if ' +
+           'positive, KiB if negative).'
+)
+root_parser.add_argument(
+    '--mmap-size',
+    action = 'store',
+    type = int,
+    default = None,
+    help = 'Override the mmap_size pragma of the profile (bytes).'
+)
+root_parser.add_argument(
+    '--busy-timeout',
+    action = 'store',
+    type = int,
+    default = None,
+    help = 'Override the busy_timeout pragma of the profile (ms).'
+)
+root_parser.add_argument(
+    '--pool-size',
+    action = 'store',
+    type = int,
+    default = 8,
+    help = 'How many database connections to keep open. Defaults to 8.'
+)
+root_parser.add_argument(
+    '--read-pool',
+    action = 'store_true',
+    help = 'Serve reads from a separate pool of --pool-size read-only ' +
+           'connections, and queue writes up for a single connection of ' +
+           'their own. Needs a write-ahead log (journal_mode wal).'
+)
+root_parser.add_argument(
+    '--async',
+    action = 'store_true',
+    dest = 'use_async',
+    help = 'Serve with the asyncio (ASGI) app instead of flask. Requires ' +
+           'python 3.5+, and the async extra (aiosqlite and uvicorn).'
+)
+root_parser.add_argument(
+    '--metrics',
+    action = 'store_true',
+    help = 'Serve Prometheus metrics at /metrics.'
+)
+root_parser.add_argument(
+    '--debug',
+    action = 'store_true',
+    help = 'Run flask in debug mode, which also adds X-Query-Count and ' +
+           'X-DB-Time headers to every response.'
+)
+root_parser.add_argument(
+    '--slow-query',
+    action = 'store',
+    type = float,
+    default = None,
+    help = 'Log statements slower than this many seconds (with their ' +
+           'parameters) to the plassets.sql logger.'
+)
+root_parser.add_argument(
+    '--workers', '-w',
+    action = 'store',
+    type = int,
+    default = None,
+    help = 'Serve from a pre-forking server with this many worker ' +
+           'processes, instead of the (single process) development ' +
+           'server. Requires the workers extra (gunicorn).'
+)
+root_parser.add_argument(
+    '--bind', '-b',
+    action = 'append',
+    type = str,
+    default = None,
+    help = 'With --workers, the address to listen on, as host:port or ' +
+           'unix:path. Can be repeated. Defaults to --host and --port.'
+)
+root_parser.add_argument(
+    '--backlog',
+    action = 'store',
+    type = int,
+    default = 2048,
+    help = 'With --workers, the maximum number of pending connections. ' +
+           'Defaults to 2048.'
+)
+
+root_parser.add_argument(
+    '--shards',
+    action = 'store',
+    type = int,
+    default = 1,
+    help = 'Spread assets across this many databases (the --database, ' +
+           'plus path.shard1, path.shard2, etc), by a hash of their ' +
+           'names. This can\'t change once there are assets. Defaults ' +
+           'to 1.'
+)
+root_parser.add_argument(
+    '--restore',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Start from this snapshot (see --snapshot). With --database, ' +
+           'the database must not exist yet (or be empty).'
+)
+root_parser.add_argument(
+    '--snapshot',
+    action = 'store',
+    type = str,
+    default = None,
+    help = 'Snapshot the database to this path every ' +
+           '--snapshot-interval seconds while serving, and again on exit.'
+)
+root_parser.add_argument(
+    '--snapshot-interval',
+    action = 'store',
+    type = float,
+    default = 600,
+    help = 'How often to --snapshot, in seconds. 0 for only on exit. ' +
+           'Defaults to 600.'
+)
+root_parser.add_argument(
+    '--in-memory',
+    action = 'store_true',
+    help = 'Map the whole database into memory, and read it all in on ' +
+           'startup, so that reads never wait on the disk.'
+)
+
+# Instead of serving, import or export the --database
+commands = root_parser.add_subparsers(dest='command')
+import_parser = commands.add_parser(
+    'import',
+    help = 'Import assets from a file into the --database.'
+)
+import_parser.add_argument(
+    'file',
+    action = 'store',
+    type = str,
+    help = 'The file to import, or - for stdin.'
+)
+import_parser.add_argument(
+    '--format', '-f',
+    action = 'store',
+    choices = FORMATS,
+    default = None,
+    help = 'The format of the file. Defaults to csv for .csv files, and ' +
+           'ndjson otherwise.'
+)
+import_parser.add_argument(
+    '--processes',
+    action = 'store',
+    type = int,
+    default = None,
+    help = 'How many processes to validate with. Defaults to one per cpu.'
+)
+import_parser.add_argument(
+    '--transaction-size',
+    action = 'store',
+    type = int,
+    default = IMPORT_TRANSACTION_SIZE,
+    help = 'How many assets to commit at a time. Defaults to %d.' %
+           IMPORT_TRANSACTION_SIZE
+)
+export_parser = commands.add_parser(
+    'export',
+    help = 'Export every asset in the --database to a file.'
+)
+export_parser.add_argument(
+    'file',
+    action = 'store',
+    type = str,
+    help = 'The file to export to, or - for stdout.'
+)
+export_parser.add_argument(
+    '--format', '-f',
+    action = 'store',
+    choices = FORMATS,
+    default = None,
+    help = 'The format of the file. Defaults to csv for .csv files, and ' +
+           'ndjson otherwise.'
+)
+
+
+# Sqlite clamps mmap_size to its compile-time maximum, so this is "all of it"
+IN_MEMORY_MMAP_SIZE = 2 ** 40
+# Snapshots, etc, log here
+logger = logging.getLogger('plassets')
+
+
+def sqlite_pragmas(args, persistent):
+    ''' Figure out the sqlite pragmas to use, per the profile and any
+    individual overrides.
+    '''
+    profile = args.profile
+    if profile is None:
+        profile = 'balanced' if persistent else 'default'
+    
+    pragmas = dict(SQLITE_PROFILES[profile])
+    overrides = {
+        'journal_mode': args.journal_mode,
+        'synchronous': args.synchronous,
+        'cache_size': args.cache_size,
+        'mmap_size': args.mmap_size,
+        'busy_timeout': args.busy_timeout,
+    }
+    pragmas.update((key, value) for key, value in overrides.items()
+                   if value is not None)
+    
+    if args.in_memory:
+        pragmas['mmap_size'] = IN_MEMORY_MMAP_SIZE
+    
+    return pragmas
+
+
+def app_config(args, db_path, persistent):
+    ''' Build the create_app config for the passed args.
+    '''
+    config = dict(
+        TESTING = False,
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path,
+        SQLALCHEMY_TRACK_MODIFICATIONS = False,
+        PLASSETS_SQLITE_PRAGMAS = sqlite_pragmas(args, persistent),
+        PLASSETS_METRICS = args.metrics,
+        PLASSETS_SLOW_QUERY_SECONDS = args.slow_query,
+        DEBUG = args.debug
+    )
+    
+    # Pragmas like the page cache are per-connection, so if we're tuning
+    # things, keep connections around instead of opening one per request.
+    # Each one is still only ever used by one thread at a time.
+    if config['PLASSETS_SQLITE_PRAGMAS']:
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': QueuePool,
+            'pool_size': args.pool_size,
+            'connect_args': {'check_same_thread': False}
+        }
+    
+    # Every worker needs to see every other worker's writes in its etags
+    if args.workers is not None:
+        config['PLASSETS_SHARED_VERSION'] = True
+    
+    if args.shards > 1:
+        config['PLASSETS_SHARDS'] = args.shards
+        config['SQLALCHEMY_BINDS'] = {
+            shard_bind(index): 'sqlite:///' + shard_path(db_path, index)
+            for index in range(1, args.shards)
+        }
+    
+    # Sqlite only has the one writer anyways, so writes wait their turn for
+    # a connection (instead of on the busy timeout), and reads never wait
+    # behind them for one
+    if args.read_pool:
+        config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+            pool_size = 1,
+            max_overflow = 0
+        )
+        config['PLASSETS_READER_DATABASE_URI'] = read_only_uri(db_path)
+        config['PLASSETS_READER_BINDS'] = {
+            shard_bind(index): read_only_uri(shard_path(db_path, index))
+            for index in range(1, args.shards)
+        }
+        config['PLASSETS_READER_ENGINE_OPTIONS'] = {
+            'poolclass': QueuePool,
+            'pool_size': args.pool_size,
+            'connect_args': {'check_same_thread': False}
+        }
+    
+    return config
+
+
+def read_only_uri(db_path):
+    ''' The sqlalchemy uri to open an sqlite database read-only.
+    '''
+    return 'sqlite:///file:' + db_path + '?mode=ro&uri=true'
+
+
+def warm_db(db_path):
+    ''' Read the whole database file once, so that it's in the OS page
+    cache (which is what the --in-memory mmap reads from).
+    '''
+    with open(db_path, 'rb') as f:
+        while f.read(1024 ** 2):
+            pass
+
+
+def take_snapshots(path, interval):
+    ''' Snapshot the database to path every interval seconds, forever.
+    This runs in its own process, so that (big) snapshots never hold up
+    requests.
+    '''
+    while True:
+        time.sleep(interval)
+        try:
+            snapshot_db(path)
+        except Exception:
+            logger.exception('Snapshot to %s failed', path)
+
+
+def start_snapshots(path, interval):
+    ''' Fork a process running take_snapshots, and return its pid. This
+    isn't a multiprocessing.Process, because gunicorn workers would
+    inherit (and then try to clean up) those.
+    '''
+    # Sqlite connections can't survive a fork, so don't hand any down
+    dispose_engines()
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            take_snapshots(path, interval)
+        finally:
+            os._exit(1)
+    
+    return pid
+
+
+def stop_snapshots(pid):
+    ''' Stop a process from start_snapshots.
+    '''
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    
+    # Already gone (and maybe already reaped, ex by gunicorn)
+    except OSError:
+        pass
+
+
+def exit_on_sigterm(signum, frame):
+    ''' Treat SIGTERM like ctrl+c, so that we still snapshot and clean up
+    on the way out.
+    '''
+    sys.exit(0)
+
+
+def open_file(path, mode):
+    ''' Open a text file for import or export (- being stdin or stdout).
+    '''
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    
+    # Newlines are left to the readers and writers (csv needs them as-is)
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def run_import(args):
+    ''' Import a file into the database, and report how it went.
+    '''
+    start = timeit.default_timer()
+    stream = open_file(args.file, 'r')
+    try:
+        stats = import_assets(
+            stream,
+            args.format or guess_format(args.file),
+            processes=args.processes,
+            transaction_size=args.transaction_size
+        )
+    
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    
+    for lineno in stats['invalid']:
+        sys.stderr.write('Invalid asset on line %d\n' % lineno)
+    
+    sys.stderr.write(
+        'Imported %d assets in %.1fs (%d conflicts, %d invalid)\n' % (
+            stats['imported'], timeit.default_timer() - start,
+            stats['conflicts'], len(stats['invalid'])))
+
+
+def run_export(args):
+    ''' Export the database to a file, and report how it went.
+    '''
+    start = timeit.default_timer()
+    stream = open_file(args.file, 'w')
+    try:
+        count = export_assets(stream, args.format or guess_format(args.file))
+    
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    
+    # Not stdout, which might be the export itself
+    sys.stderr.write('Exported %d assets in %.1fs\n' % (
+        count, timeit.default_timer() - start))
+
+
+def serve_async(args, db_path, pragmas):
+    ''' Serve the ASGI app from plassets.asgi with uvicorn.
+    '''
+    # Imported here, so that the flask server doesn't need them (or py3)
+    import uvicorn
+    from .asgi import AsyncPlassets
+    
+    # The async app has its own connections; don't leave these lying around
+    dispose_engines()
+    
+    uvicorn.run(
+        AsyncPlassets(db_path, pragmas=pragmas, pool_size=args.pool_size),
+        host=args.host,
+        port=args.port
+    )
+
+
+def serve_workers(args, app):
+    ''' Serve the app from a pre-forking (gunicorn) server. The app is
+    loaded (and the database upgraded) once, here, and the workers are
+    forked from that, instead of each paying for it again.
+    '''
+    # Imported here, so that the development server doesn't need it
+    from gunicorn.app.base import BaseApplication
+    
+    def post_fork(server, worker):
+        # create_app pushed an app context, and sync workers handle requests
+        # on this same thread, so every request would reuse it, and never
+        # tear it down (which is what cleans up the sessions)
+        while _app_ctx_stack.top is not None:
+            _app_ctx_stack.top.pop()
+    
+    options = {
+        'bind': args.bind or ['%s:%d' % (args.host, args.port)],
+        'workers': args.workers,
+        'backlog': args.backlog,
+        'preload_app': True,
+        'post_fork': post_fork,
+    }
+    
+    class PlassetsServer(BaseApplication):
+        
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return app
+    
+    # Sqlite connections can't survive a fork, so make sure the workers all
+    # start out with an empty pool, and open their own
+    dispose_engines()
+    PlassetsServer().run()
         
 
 if __name__ == '__main__':
     args = root_parser.parse_args()
     
-    try:
+    # Otherwise, nothing would ever see the slow query log (or failed
+    # snapshots)
+    if args.slow_query is not None or args.snapshot is not None:
+        logging.basicConfig()
+    
+    if args.workers is not None and args.use_async:
+        root_parser.error('--workers is not supported with --async')
+    elif args.workers is not None and args.workers < 1:
+        root_parser.error('--workers must be at least 1')
+    elif args.command is not None and args.database is None:
+        root_parser.error(args.command + ' needs a --database')
+    elif args.snapshot_interval < 0:
+        root_parser.error('--snapshot-interval must not be negative')
+    elif args.shards < 1:
+        root_parser.error('--shards must be at least 1')
+    elif args.shards > 1 and args.use_async:
+        root_parser.error('--shards is not supported with --async')
+    elif args.read_pool and args.use_async:
+        root_parser.error('--read-pool is not supported with --async ' +
+                          '(which always has one)')
+    elif (args.read_pool and sqlite_pragmas(args, args.database is not None)
+            .get('journal_mode', '').lower() != 'wal'):
+        root_parser.error('--read-pool needs a write-ahead log')
+    # Restoring from a typo would quietly start with an empty store
+    elif args.restore is not None and not all(
+            os.path.isfile(shard_path(args.restore, index))
+            for index in range(args.shards)):
+        root_parser.error('no such snapshot: ' + args.restore)
+    
+    parent_pid = os.getpid()
+    if args.database is None:
+        persistent = False
         db_fd, db_path = tempfile.mkstemp()
-        app = create_app(
-            TESTING = False,
-            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path,
-            SQLALCHEMY_TRACK_MODIFICATIONS = False
-        )
-        db.create_all()
-        app.run(host=args.host, port=args.port)
+    else:
+        persistent = True
+        db_path = os.path.abspath(args.database)
+        
+        # Don't clobber an existing store by accident
+        if (args.restore is not None and os.path.exists(db_path) and
+                os.path.getsize(db_path) > 0):
+            root_parser.error('refusing to --restore over ' + args.database)
+    
+    app = None
+    snapshotter = None
+    try:
+        if args.restore is not None:
+            restore_snapshot(args.restore, db_path, args.shards)
+        
+        app = create_app(**app_config(args, db_path, persistent))
+        # Creates the tables for new databases, too
+        upgrade_db()
+        
+        if args.in_memory:
+            for index in range(args.shards):
+                warm_db(shard_path(db_path, index))
+        
+        if args.snapshot is not None and args.snapshot_interval > 0:
+            snapshotter = start_snapshots(args.snapshot,
+                                          args.snapshot_interval)
+        
+        if args.command == 'import':
+            run_import(args)
+        elif args.command == 'export':
+            run_export(args)
+        elif args.use_async:
+            serve_async(args, db_path, app.config['PLASSETS_SQLITE_PRAGMAS'])
+        elif args.workers is not None:
+            serve_workers(args, app)
+        else:
+            # Gunicorn and uvicorn already handle this themselves
+            signal.signal(signal.SIGTERM, exit_on_sigterm)
+            # The reloader would re-run all of this in a child process
+            app.run(host=args.host, port=args.port, use_reloader=False)
         
     finally:
-        os.close(db_fd)
-        os.unlink(db_path)
+        # Workers exit through here too, but only the parent should snapshot
+        # and clean up
+        if os.getpid() == parent_pid:
+            try:
+                if snapshotter is not None:
+                    stop_snapshots(snapshotter)
+                
+                # The last word, so that nothing written since the last
+                # periodic snapshot is lost
+                if args.snapshot is not None and app is not None:
+                    snapshot_db(args.snapshot)
+            
+            finally:
+                if not persistent:
+                    os.close(db_fd)
+                    # Clean up any shards, write-ahead logs, etc, too
+                    for index in range(args.shards):
+                        path = shard_path(db_path, index)
+                        for suffix in ('', '-wal', '-shm', '-journal'):
+                            if os.path.exists(path + suffix):
+                                os.unlink(path + suffix)
@@ -0,0 +1,703 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+
+    Copyright 2017 Nick Badger.
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+
+An asyncio (ASGI) version of the plassets app, with the same routes and
+behavior as the flask one in plassets.py, and reusing its validation,
+filtering and serialization. This is the design sketched out in
+docs/jawas_plassets.py: handlers are coroutines, and database access goes
+through aiosqlite, so one process can hold open thousands of (slow)
+connections without a thread for each.
+
+Python 3.5+ only, and needs the async extra (aiosqlite, plus uvicorn to
+serve it from the command line). The package doesn't import this, so
+plassets itself still works without them.
+'''
+
+import asyncio
+import collections
+import functools
+import json
+import logging
+import sqlite3
+import urllib.parse
+
+import aiosqlite
+import sqlalchemy
+from sqlalchemy.dialects import sqlite
+
+from werkzeug.datastructures import Headers
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import abort
+from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import InternalServerError
+from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_accept_header
+from werkzeug.http import parse_etags
+from werkzeug.http import quote_etag
+from werkzeug.routing import RequestRedirect
+
+from .plassets import Asset
+from .plassets import StoreVersion
+from .plassets import WHATSITS
+from .plassets import BAD_ASSET_ERRORS
+from .plassets import MAX_IN_PARAMS
+from .plassets import STREAM_BATCH_SIZE
+from .plassets import sqlite_pragma_statements
+from .plassets import compile_filters
+from .plassets import parse_fields
+from .plassets import projection
+from .plassets import page_limit
+from .plassets import encode_cursor
+from .plassets import decode_cursor
+from .plassets import bulk_names
+from .plassets import triage_bulk
+from .plassets import asset_columns
+from .plassets import summarize_counts
+
+
+# ###############################################
+# Boilerplate and helpers
+# ###############################################
+
+
+# Control * imports.
+__all__ = ['AsyncPlassets']
+
+
+logger = logging.getLogger(__name__)
+
+
+# The queries are built with sqlalchemy (so that they're exactly the same as
+# the flask app's), but compiled and run by hand
+SQLITE_DIALECT = sqlite.dialect()
+
+INSERT_ASSET = 'INSERT INTO assets (name, type, class, details) ' + \
+               'VALUES (?, ?, ?, ?)'
+UPDATE_COUNT = 'UPDATE asset_counts SET count = count + ? ' + \
+               'WHERE type = ? AND class = ?'
+INSERT_COUNT = 'INSERT INTO asset_counts (type, class, count) ' + \
+               'VALUES (?, ?, ?)'
+SELECT_COUNTS = 'SELECT type, class, count FROM asset_counts'
+SELECT_NAMES = 'SELECT name FROM assets WHERE name IN (%s)'
+
+
+def compile_query(q):
+    ''' Compile a sqlalchemy select into sql and positional parameters,
+    ready for aiosqlite.
+    '''
+    compiled = q.compile(dialect=SQLITE_DIALECT)
+    params = compiled.params
+    return compiled.string, tuple(params[key] for key in compiled.positiontup)
+
+
+def wants_ndjson(request):
+    ''' Did the client explicitly ask for newline-delimited json?
+    '''
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+class AsyncRequest(object):
+    ''' The bits of an ASGI http request that the handlers need, parsed
+    the same way (by werkzeug) as flask would.
+    '''
+    
+    def __init__(self, scope, receive):
+        self.method = scope['method']
+        self.scheme = scope.get('scheme', 'http')
+        self.path = scope['path']
+        self.headers = Headers([
+            (key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in scope['headers']
+        ])
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = MultiDict(urllib.parse.parse_qsl(
+            self.query_string,
+            keep_blank_values=True
+        ))
+        self.accept_mimetypes = parse_accept_header(
+            self.headers.get('Accept'), MIMEAccept)
+        self.if_none_match = parse_etags(self.headers.get('If-None-Match'))
+        self._receive = receive
+    
+    def url(self, path):
+        ''' The absolute url of path on this server, with the query string
+        of the request (like werkzeug builds for redirects).
+        '''
+        host = self.headers.get('Host', 'localhost')
+        url = '%s://%s%s' % (self.scheme, host, urllib.parse.quote(path))
+        if self.query_string:
+            url += '?' + self.query_string
+        return url
+    
+    async def body(self):
+        ''' Read the whole request body.
+        '''
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await self._receive()
+            if message['type'] == 'http.disconnect':
+                abort(400)
+            
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        
+        return b''.join(chunks)
+    
+    async def json(self):
+        ''' Parse the body as json, whatever the mimetype. Bad json is a
+        400.
+        '''
+        try:
+            return json.loads((await self.body()).decode('utf-8'))
+        except ValueError:
+            abort(400)
+
+
+class AsyncResponse(object):
+    ''' A response to an AsyncRequest. Pass stream (a coroutine function
+    taking a write coroutine function) to generate the body on the fly.
+    '''
+    
+    def __init__(self, body=b'', status=200, mimetype='text/html',
+                 stream=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+        
+        self.body = body
+        self.status = status
+        self.headers = [('Content-Type', mimetype)]
+        self.stream = stream
+    
+    async def send(self, send, head=False):
+        ''' Send the response over ASGI. For HEAD requests, only send the
+        headers.
+        '''
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                   for key, value in self.headers]
+        if self.stream is None:
+            headers.append((b'content-length',
+                            str(len(self.body)).encode('latin-1')))
+        
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': headers
+        })
+        
+        if self.stream is None or head:
+            await send({
+                'type': 'http.response.body',
+                'body': b'' if head else self.body
+            })
+            return
+        
+        async def write(chunk):
+            await send({
+                'type': 'http.response.body',
+                'body': chunk.encode('utf-8'),
+                'more_body': True
+            })
+        
+        await self.stream(write)
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def json_response(data):
+    return AsyncResponse(json.dumps(data) + '\n', mimetype='application/json')
+
+
+def error_response(exc):
+    ''' The response for an HTTPException (ex from abort), with the same
+    body and headers that flask would send.
+    '''
+    # Not just get_body and get_headers, since some (ex RequestRedirect)
+    # build their own response
+    werkzeug_response = exc.get_response()
+    response = AsyncResponse(werkzeug_response.get_data(),
+                             status=werkzeug_response.status_code)
+    response.headers = werkzeug_response.headers.to_wsgi_list()
+    return response
+
+
+# ###############################################
+# App
+# ###############################################
+
+
+class AsyncPlassets(object):
+    ''' The ASGI app. db_path is an sqlite database with the plassets
+    schema already in place (see plassets.upgrade_db); pragmas is a dict
+    like plassets.SQLITE_PROFILES['balanced'].
+    
+    All writes go through a single connection (sqlite only allows one
+    writer at a time anyways), and reads share a pool of pool_size more.
+    Connections are opened at lifespan startup, or on the first request
+    if the server doesn't support lifespans.
+    '''
+    
+    def __init__(self, db_path, pragmas=None, pool_size=8, asset_cache=None):
+        self.db_path = db_path
+        self.pragmas = pragmas or {}
+        self.pool_size = pool_size
+        # An LRUCache, or None; see plassets.init_asset_cache
+        self.asset_cache = asset_cache
+        self.version = StoreVersion()
+        self.stream_batch_size = STREAM_BATCH_SIZE
+        
+        self._opening = None
+        self._writer = None
+        self._write_lock = None
+        self._readers = None
+        
+        # {path: {method: handler}}. GETs are all versioned.
+        self.routes = {
+            '/': {'GET': self.show_silly_make},
+            '/assets/v1/': {
+                'GET': self.show_all_assets,
+                'POST': self.make_new_asset
+            },
+            '/assets/v1/_bulk': {'POST': self.make_new_assets},
+            '/assets/v1/_stats': {'GET': self.show_asset_stats},
+            '/assets/v1/sat': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='satellite')
+            },
+            '/assets/v1/sat/dove': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='satellite',
+                                         asset_class='dove')
+            },
+            '/assets/v1/sat/rapideye': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='satellite',
+                                         asset_class='rapideye')
+            },
+            '/assets/v1/ant/': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='antenna')
+            },
+            '/assets/v1/ant/dish': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='antenna',
+                                         asset_class='dish')
+            },
+            '/assets/v1/ant/yagi': {
+                'GET': functools.partial(self.list_assets,
+                                         asset_type='antenna',
+                                         asset_class='yagi')
+            },
+        }
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+    
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.open()
+                except Exception as exc:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': repr(exc)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    async def open(self):
+        ''' Open the database connections, if they aren't already.
+        '''
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._connect())
+        await self._opening
+    
+    async def _connect(self):
+        statements = sqlite_pragma_statements(self.pragmas)
+        
+        self._writer = await self._connection(statements)
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        for __ in range(self.pool_size):
+            self._readers.put_nowait(await self._connection(statements))
+    
+    async def _connection(self, statements):
+        # Autocommit, so that we control the transactions
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        for statement in statements:
+            await conn.execute(statement)
+        return conn
+    
+    async def close(self):
+        ''' Close all of the database connections.
+        '''
+        if self._opening is None:
+            return
+        
+        await self._opening
+        await self._writer.close()
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        self._opening = None
+    
+    def match(self, request):
+        ''' Find the handler (and its kwargs) for the request.
+        '''
+        # HEAD is a GET without the body, same as for flask
+        method = 'GET' if request.method == 'HEAD' else request.method
+        
+        kwargs = {}
+        methods = self.routes.get(request.path)
+        
+        # Like werkzeug's strict_slashes: routes that end in a slash redirect
+        # there from without it
+        if methods is None and request.path + '/' in self.routes:
+            raise RequestRedirect(request.url(request.path + '/'))
+        
+        elif methods is None:
+            prefix, __, name = request.path.rpartition('/')
+            if prefix != '/assets/v1' or not name:
+                raise NotFound()
+            
+            methods = {'GET': self.show_single_asset}
+            kwargs['name'] = name
+        
+        if method not in methods:
+            raise MethodNotAllowed(valid_methods=sorted(methods))
+        
+        return method, methods[method], kwargs
+    
+    async def handle(self, scope, receive, send):
+        request = AsyncRequest(scope, receive)
+        
+        try:
+            method, handler, kwargs = self.match(request)
+            await self.open()
+            
+            if method == 'GET':
+                response = await self.versioned(handler, request, kwargs)
+            else:
+                response = await handler(request, **kwargs)
+        
+        except HTTPException as exc:
+            response = error_response(exc)
+        
+        except Exception:
+            logger.exception('Error handling %s %s', request.method,
+                             request.path)
+            response = error_response(InternalServerError())
+        
+        await response.send(send, head=request.method == 'HEAD')
+    
+    async def versioned(self, handler, request, kwargs):
+        ''' Equivalent to plassets.versioned: ETag the response with the
+        current store version, and answer If-None-Match requests for it
+        with a 304 before doing any work.
+        '''
+        # Grab this *before* building the response; see plassets.versioned
+        etag = self.version.etag
+        if wants_ndjson(request):
+            etag += '-ndjson'
+        
+        if request.if_none_match.contains_weak(etag):
+            response = AsyncResponse(status=304)
+        else:
+            response = await handler(request, **kwargs)
+        
+        response.headers.append(('ETag', quote_etag(etag)))
+        response.headers.append(('Vary', 'Accept'))
+        return response
+    
+    def require_admin(self, request):
+        ''' Require X-User: admin header.
+        '''
+        if request.headers.get('X-User') != 'admin':
+            abort(401)
+    
+    # ###############################################
+    # Database access
+    # ###############################################
+    
+    async def fetch(self, sql, params=()):
+        ''' Run a query on one of the readers, returning all of its rows.
+        '''
+        conn = await self._readers.get()
+        try:
+            cursor = await conn.execute(sql, params)
+            try:
+                return await cursor.fetchall()
+            finally:
+                await cursor.close()
+        
+        finally:
+            self._readers.put_nowait(conn)
+    
+    async def fetch_query(self, q):
+        ''' Run a sqlalchemy select on one of the readers.
+        '''
+        sql, params = compile_query(q)
+        return await self.fetch(sql, params)
+    
+    async def existing_names(self, names):
+        ''' Equivalent to plassets.existing_names.
+        '''
+        names = list(names)
+        taken = set()
+        
+        for ii in range(0, len(names), MAX_IN_PARAMS):
+            chunk = names[ii:ii + MAX_IN_PARAMS]
+            sql = SELECT_NAMES % ','.join('?' * len(chunk))
+            taken.update(name for name, in await self.fetch(sql, chunk))
+        
+        return taken
+    
+    async def insert(self, rows):
+        ''' Insert new assets (as rows, see plassets.asset_columns) in a
+        single transaction, along with their counts. Raises
+        sqlite3.IntegrityError if any of the names are taken.
+        '''
+        if not rows:
+            return
+        
+        counts = collections.Counter((row[1], row[2]) for row in rows)
+        
+        async with self._write_lock:
+            await self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                await self._writer.executemany(INSERT_ASSET, rows)
+                
+                for (asset_type, asset_class), count in counts.items():
+                    cursor = await self._writer.execute(
+                        UPDATE_COUNT, (count, asset_type, asset_class))
+                    if cursor.rowcount == 0:
+                        await self._writer.execute(
+                            INSERT_COUNT, (asset_type, asset_class, count))
+            
+            except BaseException:
+                await self._writer.execute('ROLLBACK')
+                raise
+            
+            await self._writer.execute('COMMIT')
+        
+        self.version.bump()
+    
+    # ###############################################
+    # Handlers
+    # ###############################################
+    
+    async def show_silly_make(self, request):
+        return AsyncResponse(WHATSITS)
+    
+    async def make_new_asset(self, request):
+        ''' Make a new asset, per a json request.
+        '''
+        self.require_admin(request)
+        data = await request.json()
+        
+        try:
+            asset = Asset.from_json(data)
+        
+        except BAD_ASSET_ERRORS:
+            abort(400)
+        
+        try:
+            await self.insert([asset_columns(asset)])
+        
+        except sqlite3.IntegrityError:
+            abort(409)
+        
+        return AsyncResponse()
+    
+    async def make_new_assets(self, request):
+        ''' Make many new assets at once; see plassets.make_new_assets.
+        '''
+        self.require_admin(request)
+        data = await request.json()
+        
+        if not isinstance(data, list):
+            abort(400)
+        
+        names = bulk_names(data)
+        taken = await self.existing_names(set(names) - {None})
+        results, assets = triage_bulk(names, data, taken)
+        
+        try:
+            await self.insert([asset_columns(asset) for asset in assets])
+        
+        except sqlite3.IntegrityError:
+            abort(409)
+        
+        return json_response(results)
+    
+    async def show_all_assets(self, request):
+        ''' Get all existing assets; see plassets.show_all_assets.
+        '''
+        return await self.list_assets(request)
+    
+    async def show_asset_stats(self, request):
+        ''' Get the number of assets of each type and class.
+        '''
+        rows = await self.fetch(SELECT_COUNTS)
+        return json_response(summarize_counts(rows))
+    
+    async def show_single_asset(self, request, name):
+        ''' Get a single existing asset, by name.
+        '''
+        fields = parse_fields(request.args)
+        
+        # Only whole assets get cached
+        cache = self.asset_cache
+        if fields is not None:
+            cache = None
+        
+        if cache is not None:
+            body = cache.get(name)
+            if body is not None:
+                return AsyncResponse(body, mimetype='application/json')
+        
+        columns, serialize = projection(fields)
+        q = sqlalchemy.select(list(columns)).where(
+            Asset._name == name).limit(1)
+        rows = await self.fetch_query(q)
+        
+        # Don't cache 404s; the asset might get created later
+        if not rows:
+            abort(404)
+        
+        body = (serialize(rows[0]) + '\n').encode('utf-8')
+        if cache is not None:
+            cache.put(name, body)
+        
+        return AsyncResponse(body, mimetype='application/json')
+    
+    async def list_assets(self, request, asset_type=None, asset_class=None):
+        ''' The (name-ordered) listing for the filter args in the request;
+        see plassets.list_assets and plassets.asset_listing.
+        '''
+        criteria = compile_filters(request.args)
+        
+        if asset_type is not None:
+            criteria.append(Asset._asset_type == asset_type)
+        if asset_class is not None:
+            criteria.append(Asset._asset_class == asset_class)
+        
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            criteria.append(Asset._name > decode_cursor(cursor))
+        
+        columns, serialize = projection(parse_fields(request.args))
+        q = sqlalchemy.select(list(columns)).order_by(Asset._name)
+        for criterion in criteria:
+            q = q.where(criterion)
+        
+        limit = page_limit(request.args)
+        ndjson = wants_ndjson(request)
+        if ndjson or request.args.get('stream') in ('1', 'true'):
+            return self.stream_listing(q, limit, ndjson, serialize)
+        
+        if limit is None:
+            rows = await self.fetch_query(q)
+        else:
+            # Grab one extra row so we know if there's a next page at all
+            rows = await self.fetch_query(q.limit(limit + 1))
+        
+        response = AsyncResponse(
+            '[' + ','.join(serialize(row) for row in rows[:limit]) + ']\n',
+            mimetype='application/json'
+        )
+        
+        if limit is not None and len(rows) > limit:
+            response.headers.append(('X-Next-Cursor',
+                                     encode_cursor(rows[limit - 1][0])))
+        
+        return response
+    
+    def stream_listing(self, q, limit, ndjson, serialize):
+        ''' Stream a name-ordered query to the client; see
+        plassets.stream_listing. Like there, every batch is its own
+        (keyset-paginated) query, so a slow client never ties up a
+        database connection while we wait for it to read.
+        '''
+        if ndjson:
+            mimetype = 'application/x-ndjson'
+            head, tail = '', ''
+            
+            def render(chunk, first):
+                return '\n'.join(chunk) + '\n'
+        
+        else:
+            mimetype = 'application/json'
+            head, tail = '[', ']\n'
+            
+            def render(chunk, first):
+                return ('' if first else ',') + ','.join(chunk)
+        
+        async def stream(write):
+            await write(head)
+            
+            remaining = limit
+            batch = q
+            first = True
+            while remaining is None or remaining > 0:
+                batch_size = self.stream_batch_size
+                if remaining is not None:
+                    batch_size = min(batch_size, remaining)
+                    remaining -= batch_size
+                
+                rows = await self.fetch_query(batch.limit(batch_size))
+                if rows:
+                    await write(render([serialize(row) for row in rows],
+                                       first))
+                    first = False
+                
+                if len(rows) < batch_size:
+                    break
+                batch = q.where(Asset._name > rows[-1][0])
+            
+            await write(tail)
+        
+        return AsyncResponse(mimetype=mimetype, stream=stream)
@@ -0,0 +1,385 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Plassets: Planet Labs asset store coding exercise
+
+    The MIT license (MIT)
+    
+    Copyright 2017 Nick Badger.
+    
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation files
+    (the "Software"), to deal in the Software without restriction,
+    including without limitation the rights to use, copy, modify, merge,
+    publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so,
+    subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+    BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+    ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+
+------------------------------------------------------
+
+Streaming bulk import and export of assets, as NDJSON (one asset per line,
+exactly as the api serves them) or CSV (name, type, class and details
+columns, the details as json). This is what backs python -m plassets import
+and export.
+
+Imports skip the api (and the session) entirely: records are parsed and
+validated across a process pool, by the same rules as Asset, and the valid
+ones are written with executemany, in large transactions (on every shard at
+once, if the store is sharded).
+'''
+
+import collections
+import csv
+import functools
+import json
+import multiprocessing
+import operator
+import threading
+
+import sqlalchemy
+
+from .plassets import app
+from .plassets import Asset
+from .plassets import BAD_ASSET_ERRORS
+from .plassets import SERIALIZED_COLUMNS
+from .plassets import validate_asset
+from .plassets import dump_details
+from .plassets import serialize_asset
+from .plassets import add_asset_counts
+from .plassets import shard_engines
+from .plassets import shard_index
+from .plassets import gather
+
+
+# ###############################################
+# Boilerplate and helpers
+# ###############################################
+
+
+# Control * imports.
+__all__ = ['import_assets', 'export_assets']
+
+
+FORMATS = ('ndjson', 'csv')
+CSV_COLUMNS = ('name', 'type', 'class', 'details')
+# How many records to send to a validation worker at a time
+VALIDATE_CHUNK_SIZE = 5000
+# How many rows to insert per transaction. Bigger is faster (fewer fsyncs),
+# but holds the write lock (and memory) for longer.
+IMPORT_TRANSACTION_SIZE = 100000
+# How many rows to pull from the cursor at a time when exporting
+EXPORT_BATCH_SIZE = 5000
+# Duplicate names (already in the store, or earlier in the file) are
+# skipped, not errors; see insert_rows
+INSERT_SQL = 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (
+    Asset.__tablename__,
+    ', '.join(column.name for column in SERIALIZED_COLUMNS),
+    ', '.join('?' for column in SERIALIZED_COLUMNS)
+)
+
+
+def guess_format(path):
+    ''' The format for a file, from its extension: csv for .csv, and
+    ndjson otherwise.
+    '''
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    else:
+        return 'ndjson'
+
+
+def read_records(stream, fmt):
+    ''' Read (line number, record) from a text stream. Records are only
+    split up here, not parsed: ndjson lines are left as strings, and csv
+    rows as dicts with the details still as json.
+    '''
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    
+    else:
+        for lineno, line in enumerate(stream, 1):
+            # Tolerate blank lines (ex a trailing one)
+            if line.strip():
+                yield lineno, line
+
+
+def chunked(iterable, size):
+    ''' Split an iterable into lists of (up to) size items.
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    
+    if chunk:
+        yield chunk
+
+
+def prepare_record(record):
+    ''' Parse and validate a record from read_records, just like
+    Asset.from_json would. Returns the row to insert, in the order of
+    SERIALIZED_COLUMNS. Raises one of BAD_ASSET_ERRORS if it's invalid.
+    '''
+    if isinstance(record, dict):
+        data = dict(record)
+        data['details'] = json.loads(record.get('details') or '{}')
+    else:
+        data = json.loads(record)
+    
+    name = data['name']
+    asset_type = data['type']
+    asset_class = data['class']
+    details = data['details']
+    
+    # Asset(**details) would choke on these
+    if not isinstance(details, dict):
+        raise TypeError(details)
+    
+    validate_asset(name, asset_type, asset_class, details)
+    return (name, asset_type, asset_class,
+            dump_details(details) if details else None)
+
+
+def prepare_records(chunk):
+    ''' Run prepare_record over a chunk of (line number, record). This is
+    what runs in the validation workers. Returns (rows, invalid line
+    numbers).
+    '''
+    rows = []
+    invalid = []
+    for lineno, record in chunk:
+        try:
+            rows.append(prepare_record(record))
+        
+        except BAD_ASSET_ERRORS:
+            invalid.append(lineno)
+    
+    return rows, invalid
+
+
+def prepare_all(records, pool, processes):
+    ''' Run prepare_records over every record, in chunks, across the
+    pool of processes (or inline, if it's None). Yields the results in
+    order. Only a couple of chunks per worker are in flight at a time, so
+    huge files aren't read into memory all at once.
+    '''
+    chunks = chunked(records, VALIDATE_CHUNK_SIZE)
+    
+    if pool is None:
+        for chunk in chunks:
+            yield prepare_records(chunk)
+        return
+    
+    pending = collections.deque()
+    max_pending = 2 * processes
+    for chunk in chunks:
+        pending.append(pool.apply_async(prepare_records, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    
+    while pending:
+        yield pending.popleft().get()
+
+
+def insert_rows(conn, rows):
+    ''' Insert rows (as from prepare_record) with executemany, and update
+    the asset counts to match, on conn (which must be in a transaction).
+    Rows with names that are already taken are skipped. Returns how many
+    were actually inserted.
+    '''
+    by_kind = collections.defaultdict(list)
+    for row in rows:
+        by_kind[row[1], row[2]].append(row)
+    
+    # One executemany per type and class, so that the rowcounts (which skip
+    # the ignored duplicates) tell us exactly what to add to the counts.
+    # Inserting in name order keeps the index updates local, which is much
+    # faster for big batches.
+    counts = {}
+    for kind, kind_rows in by_kind.items():
+        kind_rows.sort(key=operator.itemgetter(0))
+        counts[kind] = conn.execute(INSERT_SQL, kind_rows).rowcount
+    
+    add_asset_counts(conn, counts)
+    return sum(counts.values())
+
+
+def in_parallel(funcs):
+    ''' Call every function at once, each in its own thread, and wait for
+    all of them. Returns their results, in order. Re-raises the first
+    error, if any.
+    '''
+    if len(funcs) == 1:
+        return [funcs[0]()]
+    
+    results = [None] * len(funcs)
+    errors = []
+    
+    def call(index, func):
+        try:
+            results[index] = func()
+        except Exception as exc:
+            errors.append(exc)
+    
+    threads = [threading.Thread(target=call, args=(index, func))
+               for index, func in enumerate(funcs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise errors[0]
+    
+    return results
+
+
+def fetch_batches(result):
+    ''' Iterate over a result, EXPORT_BATCH_SIZE rows at a time.
+    '''
+    while True:
+        rows = result.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        
+        for row in rows:
+            yield row
+
+
+# ###############################################
+# Lib
+# ###############################################
+
+
+def import_assets(stream, fmt='ndjson', processes=None,
+                  transaction_size=IMPORT_TRANSACTION_SIZE):
+    ''' Import assets from a text stream, in the passed format, into the
+    app's database. Validation is spread across a pool of processes
+    (defaulting to one per cpu; pass 1 to validate inline instead), and
+    every transaction_size valid rows are committed together.
+    
+    Invalid records are skipped, as are assets whose names are already
+    taken. Returns a dict of the number of assets imported, the number of
+    conflicts, and the line numbers of the invalid records:
+    
+    {"imported": 999998, "conflicts": 1, "invalid": [7]}
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(fmt)
+    
+    stats = {'imported': 0, 'conflicts': 0, 'invalid': []}
+    
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    else:
+        pool = None
+    
+    engines = shard_engines(app)
+    version = app.extensions.get('plassets_version')
+    
+    def commit_shard(engine, rows):
+        # Each in its own thread, so each with its own connection
+        with engine.begin() as conn:
+            return insert_rows(conn, rows)
+    
+    def commit(rows):
+        if len(engines) == 1:
+            by_shard = {0: rows}
+        else:
+            by_shard = collections.defaultdict(list)
+            for row in rows:
+                by_shard[shard_index(row[0], len(engines))].append(row)
+        
+        # Shards are separate databases, so they can all write at once
+        imported = sum(in_parallel([
+            functools.partial(commit_shard, engines[index], shard_rows)
+            for index, shard_rows in by_shard.items()
+        ]))
+        stats['imported'] += imported
+        stats['conflicts'] += len(rows) - imported
+        
+        # Same as a write through the api
+        if imported and version is not None:
+            version.bump()
+    
+    try:
+        rows = []
+        records = read_records(stream, fmt)
+        for chunk_rows, invalid in prepare_all(records, pool, processes):
+            rows.extend(chunk_rows)
+            stats['invalid'].extend(invalid)
+            
+            if len(rows) >= transaction_size:
+                commit(rows)
+                rows = []
+        
+        if rows:
+            commit(rows)
+    
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    
+    return stats
+
+
+def export_assets(stream, fmt='ndjson'):
+    ''' Write every asset in the app's database to a text stream, in the
+    passed format, ordered by name. Rows are streamed from a cursor (per
+    shard, merged back into name order), so this never holds more than
+    EXPORT_BATCH_SIZE of them (per shard) in memory. Returns how many
+    were exported.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(fmt)
+    
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(CSV_COLUMNS)
+    
+    count = 0
+    q = sqlalchemy.select(SERIALIZED_COLUMNS).order_by(Asset._name)
+    conns = [engine.connect() for engine in shard_engines(app)]
+    
+    try:
+        results = [conn.execution_options(stream_results=True).execute(q)
+                   for conn in conns]
+        
+        for rows in chunked(gather([fetch_batches(result)
+                                    for result in results]),
+                            EXPORT_BATCH_SIZE):
+            if fmt == 'csv':
+                writer.writerows(
+                    (name, asset_type, asset_class, details or '{}')
+                    for name, asset_type, asset_class, details in rows)
+            else:
+                stream.write(''.join(serialize_asset(*row) + '\n'
+                                     for row in rows))
+            
+            count += len(rows)
+    
+    finally:
+        for conn in conns:
+            conn.close()
+    
+    return count
@@ -33,17 +33,38 @@ Plassets: Planet Labs asset store coding exercise
 
 import logging
 import functools
+import collections
+import threading
+import multiprocessing
+import operator
+import os
+import base64
+import binascii
+import bisect
+import heapq
+import itertools
 import json
+import math
 import re
+import sqlite3
+import timeit
+import zlib
 
 from flask import Flask
 from flask import request
 from flask import abort
 from flask import jsonify
 from flask import Response
+from flask import stream_with_context
+from flask import g
+from flask import has_request_context
 
 from flask_sqlalchemy import SQLAlchemy
 
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import flag_dirty
 from sqlalchemy.ext.hybrid import hybrid_property
 
 
@@ -59,6 +80,8 @@ __all__ = ['app', 'db']
 # Flask stuff
 app = Flask(__name__)
 db = SQLAlchemy()
+# Statements slower than PLASSETS_SLOW_QUERY_SECONDS get logged here
+sql_logger = logging.getLogger('plassets.sql')
 
 
 # Decorators
@@ -79,16 +102,770 @@ def admin_required(func):
         return func(*args, **kwargs)
         
     return wrapper
+
+
+def versioned(func):
+    ''' ETag the response with the current store version, and answer
+    If-None-Match requests for it with a 304 before doing any work.
+    
+    Only for GETs: the store is append-only, so for those, the url and
+    store version fully determine the response.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        version = app.extensions.get('plassets_version')
+        if version is None:
+            return func(*args, **kwargs)
+        
+        # Grab this *before* building the response. If there's a write while
+        # we're building it, the response might be newer than the etag, which
+        # is harmless; the other way around would not be.
+        etag = version.etag
+        # Same url, different representation: needs a different etag
+        if wants_ndjson():
+            etag += '-ndjson'
+        
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = app.make_response(func(*args, **kwargs))
+        
+        response.set_etag(etag)
+        response.vary.add('Accept')
+        return response
+    
+    return wrapper
+
+
+class StoreVersion(object):
+    ''' Counts committed writes to the store. Since the store is append
+    only, this fully determines its contents. The epoch is random per
+    process start, so versions from an older run (or a different
+    database) can't be confused for current ones.
+    '''
+    
+    def __init__(self):
+        self.epoch = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def etag(self):
+        return '%s-%d' % (self.epoch, self.value)
+    
+    def bump(self):
+        with self._lock:
+            self.value += 1
+
+
+class SharedStoreVersion(StoreVersion):
+    ''' A StoreVersion shared with every process forked after it's
+    created (ex pre-forked server workers), so that a write in any of them
+    changes the etags in all of them.
+    '''
+    
+    def __init__(self):
+        self._shared = multiprocessing.Value('q', 0)
+        super(SharedStoreVersion, self).__init__()
+    
+    @property
+    def value(self):
+        return self._shared.value
+    
+    @value.setter
+    def value(self, value):
+        self._shared.value = value
+    
+    def bump(self):
+        with self._shared.get_lock():
+            self._shared.value += 1
+
+
+def shard_bind(index):
+    ''' The SQLALCHEMY_BINDS key for shard index (1 and up; shard 0 is
+    the app's main database).
+    '''
+    return 'shard%d' % index
+
+
+def shard_path(path, index):
+    ''' Where the database file (or snapshot) for shard index goes, for
+    a store (or snapshot) at path. Shard 0 is path itself.
+    '''
+    if index == 0:
+        return path
+    else:
+        return '%s.shard%d' % (path, index)
+
+
+def shard_index(name, count):
+    ''' Which of count shards an asset lives on. This must never change
+    (or differ between processes), so it's crc32 rather than hash().
+    '''
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % count
+
+
+def shard_engines(app):
+    ''' The engine for every shard of the app's store, in order. Unsharded
+    (PLASSETS_SHARDS unset, or 1), that's just its main engine.
+    '''
+    count = app.config.get('PLASSETS_SHARDS', 1)
+    return [db.get_engine(app)] + [db.get_engine(app, shard_bind(index))
+                                   for index in range(1, count)]
+
+
+class Shards(object):
+    ''' The (scoped) sessions for each shard of a sharded store. Assets
+    live on exactly one shard, per shard_index; shard 0 is the app's main
+    database, so its session is just db.session.
+    '''
+    
+    def __init__(self, app, count):
+        # No binds, or flask_sqlalchemy would send the assets table to the
+        # main database, regardless of bind
+        self.sessions = [db.session] + [
+            db.create_scoped_session({
+                'bind': db.get_engine(app, shard_bind(index)),
+                'binds': {}
+            }) for index in range(1, count)
+        ]
+        
+        for session in self.sessions[1:]:
+            for identifier, hook in SESSION_HOOKS:
+                event.listen(session, identifier, hook)
+    
+    def __len__(self):
+        return len(self.sessions)
+    
+    def session_for(self, name):
+        return self.sessions[shard_index(name, len(self.sessions))]
+    
+    def remove(self):
+        for session in self.sessions[1:]:
+            session.remove()
+
+
+def init_shards(app):
+    ''' (Re)create the shards for the app, if PLASSETS_SHARDS (the number
+    of them) is more than 1. Shards after the first are the databases in
+    SQLALCHEMY_BINDS under shard_bind(1), shard_bind(2), etc. Returns them
+    (or None, if the store isn't sharded).
+    
+    The number of shards can't change once there are assets, since that
+    would move them to different shards.
+    '''
+    count = app.config.get('PLASSETS_SHARDS', 1)
+    if count > 1:
+        shards = Shards(app, count)
+    else:
+        shards = None
+    
+    app.extensions['plassets_shards'] = shards
+    return shards
+
+
+class Readers(object):
+    ''' Separate engines (and scoped sessions) to read each shard of the
+    store through, so that listing scans never hold up writes for a
+    connection (or the other way around). Unlike the shards, these are
+    plain sqlalchemy engines, configured by PLASSETS_READER_ENGINE_OPTIONS.
+    '''
+    
+    def __init__(self, app, count):
+        uris = [app.config['PLASSETS_READER_DATABASE_URI']]
+        binds = app.config.get('PLASSETS_READER_BINDS', {})
+        uris.extend(binds[shard_bind(index)] for index in range(1, count))
+        options = app.config.get('PLASSETS_READER_ENGINE_OPTIONS', {})
+        
+        self.engines = [sqlalchemy.create_engine(uri, **options)
+                        for uri in uris]
+        # No binds, same as the shards
+        self.sessions = [
+            db.create_scoped_session({'bind': engine, 'binds': {}})
+            for engine in self.engines
+        ]
+    
+    def session_for(self, name):
+        return self.sessions[shard_index(name, len(self.sessions))]
+    
+    def remove(self):
+        for session in self.sessions:
+            session.remove()
+    
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def init_readers(app):
+    ''' (Re)create the readers for the app, if PLASSETS_READER_DATABASE_URI
+    is in its config; GETs then read through those. Sharded stores need a
+    reader for every other shard, too, in PLASSETS_READER_BINDS (keyed
+    like SQLALCHEMY_BINDS). Returns them (or None, if reads go through
+    the same engines as writes).
+    
+    The readers should be read-only (for sqlite, a mode=ro uri), and the
+    database should be in write-ahead log mode, so that they never wait
+    on the writer.
+    '''
+    old = app.extensions.get('plassets_readers')
+    if old is not None:
+        old.dispose()
+    
+    if app.config.get('PLASSETS_READER_DATABASE_URI') is not None:
+        readers = Readers(app, app.config.get('PLASSETS_SHARDS', 1))
+    else:
+        readers = None
+    
+    app.extensions['plassets_readers'] = readers
+    return readers
+
+
+def all_engines(app):
+    ''' Every engine the app uses: those for its shards (see
+    shard_engines), and then those for its readers, if any.
+    '''
+    engines = shard_engines(app)
+    readers = app.extensions.get('plassets_readers')
+    if readers is not None:
+        engines.extend(readers.engines)
+    
+    return engines
+
+
+def dispose_engines():
+    ''' Close every pooled connection the app has open. Sqlite connections
+    can't survive a fork, so do this before forking.
+    '''
+    for engine in all_engines(app):
+        engine.dispose()
+
+
+# Named sets of sqlite pragmas, from safest to fastest. All but the default
+# use write-ahead logging, so readers don't block behind the (single) writer.
+SQLITE_PROFILES = {
+    # Whatever sqlite does out of the box
+    'default': {},
+    # Survives power loss, at the cost of an fsync on every commit
+    'durable': {
+        'journal_mode': 'wal',
+        'synchronous': 'full',
+        'busy_timeout': 5000,
+    },
+    # Survives application crashes, but not necessarily power loss
+    'balanced': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 ** 2,
+        'busy_timeout': 5000,
+    },
+    # Can corrupt the database on power loss. Only for stores that can be
+    # rebuilt from elsewhere!
+    'fast': {
+        'journal_mode': 'wal',
+        'synchronous': 'off',
+        'cache_size': -256 * 1024,
+        'mmap_size': 1024 ** 3,
+        'busy_timeout': 5000,
+    },
+}
+# The pragmas we know how to apply, in the order we apply them (and their
+# allowable values, if they aren't integers)
+SQLITE_PRAGMAS = (
+    ('journal_mode', {'delete', 'truncate', 'persist', 'memory', 'wal',
+                      'off'}),
+    ('synchronous', {'off', 'normal', 'full', 'extra'}),
+    ('cache_size', int),
+    ('mmap_size', int),
+    ('busy_timeout', int),
+)
+
+
+def sqlite_pragma_statements(pragmas):
+    ''' The PRAGMA statements for a dict of pragmas (ex
+    SQLITE_PROFILES['balanced']), in the order to run them. Raises
+    ValueError for bad values.
+    '''
+    statements = []
+    for pragma, allowed in SQLITE_PRAGMAS:
+        if pragma not in pragmas:
+            continue
+        
+        # These get formatted straight into the sql, so be paranoid
+        value = pragmas[pragma]
+        if allowed is int:
+            value = int(value)
+        elif value.lower() not in allowed:
+            raise ValueError(value)
+        
+        statements.append('PRAGMA %s = %s' % (pragma, value))
+    
+    return statements
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    ''' Engine connect hook applying the PLASSETS_SQLITE_PRAGMAS from
+    the app config (a dict, ex SQLITE_PROFILES['balanced']) to every
+    new connection.
+    '''
+    pragmas = app.config.get('PLASSETS_SQLITE_PRAGMAS')
+    if not pragmas:
+        return
+    
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in sqlite_pragma_statements(pragmas):
+            cursor.execute(statement)
+    
+    finally:
+        cursor.close()
+
+
+def init_sqlite_pragmas(app):
+    ''' Make sure the app's engines apply PLASSETS_SQLITE_PRAGMAS to all
+    of their connections (if they're sqlite).
+    '''
+    for engine in all_engines(app):
+        if engine.dialect.name != 'sqlite':
+            continue
+        
+        if not event.contains(engine, 'connect', apply_sqlite_pragmas):
+            event.listen(engine, 'connect', apply_sqlite_pragmas)
+
+
+def init_store_version(app):
+    ''' (Re)create the store version for the app. Returns it. If the app
+    will be forked into multiple processes, set PLASSETS_SHARED_VERSION
+    in the config (and call this before forking).
+    '''
+    if app.config.get('PLASSETS_SHARED_VERSION', False):
+        version = SharedStoreVersion()
+    else:
+        version = StoreVersion()
+    
+    app.extensions['plassets_version'] = version
+    return version
+
+
+class LRUCache(object):
+    ''' A thread-safe least-recently-used cache of bytes, bounded both by
+    number of entries and by their total size. Keeps hit/miss counts.
+    '''
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        ''' Get the value for key, or None if it isn't cached.
+        '''
+        with self._lock:
+            try:
+                # Pop and reinsert to mark as most recently used
+                value = self._entries.pop(key)
+            
+            except KeyError:
+                self.misses += 1
+                return None
+            
+            self._entries[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        ''' Cache value under key, evicting the least recently used
+        entries as needed to stay within bounds.
+        '''
+        # Not worth blowing away the whole cache for
+        if len(value) > self.max_bytes:
+            return
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            
+            self._entries[key] = value
+            self.size += len(value)
+            
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                __, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def init_asset_cache(app):
+    ''' (Re)create the single asset response cache for the app, per its
+    config. Assets are immutable (through the API, anyways), so cached
+    responses never need to be invalidated. Returns the cache (or None,
+    if it's disabled).
+    '''
+    if app.config.get('PLASSETS_ASSET_CACHE', False):
+        cache = LRUCache(
+            app.config.get('PLASSETS_ASSET_CACHE_MAX_ENTRIES', 10000),
+            app.config.get('PLASSETS_ASSET_CACHE_MAX_BYTES', 16 * 1024 ** 2)
+        )
+    else:
+        cache = None
+    
+    app.extensions['plassets_asset_cache'] = cache
+    return cache
+
+
+def prometheus_labels(**labels):
+    ''' Format labels for the Prometheus text format.
+    '''
+    return '{' + ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    ) + '}'
+
+
+class Metrics(object):
+    ''' Request, database pool, and cache metrics, kept in memory and
+    rendered in the Prometheus text format. Thread-safe, and cheap enough
+    to leave on: recording a request is a lock, a couple of bisects, and
+    some additions.
+    
+    In a multi-process server, every worker has its own.
+    '''
+    # Upper bounds of the histogram buckets (plus +Inf)
+    LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                       2.5, 5, 10)
+    SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+    
+    def __init__(self):
+        self.requests = collections.Counter()
+        # {endpoint: [count per bucket (+Inf last), sum]}
+        self.latencies = {}
+        self.sizes = {}
+        self.pool_checkouts = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _observe(histograms, key, buckets, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+    
+    def observe_request(self, endpoint, method, status, seconds, size):
+        ''' Record a request. size is None if it isn't known (ex for
+        streamed responses).
+        '''
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            self._observe(self.latencies, endpoint, self.LATENCY_BUCKETS,
+                          seconds)
+            if size is not None:
+                self._observe(self.sizes, endpoint, self.SIZE_BUCKETS, size)
+    
+    def observe_checkout(self):
+        with self._lock:
+            self.pool_checkouts += 1
     
+    def render(self, pools=(), cache=None):
+        ''' Render everything in the Prometheus text format, including the
+        current state of the asset cache and (sqlalchemy) pools, if passed.
+        pools is a list of (labels, pool), with a dict of labels for each
+        pool's gauges (see engine_pools).
+        '''
+        lines = []
+        
+        def metric(name, kind, description):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+        
+        def histograms(name, histograms, buckets):
+            for endpoint, histogram in sorted(histograms.items()):
+                total = 0
+                for bound, count in zip(buckets + ('+Inf',), histogram):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, prometheus_labels(
+                        endpoint=endpoint, le=bound), total))
+                
+                labels = prometheus_labels(endpoint=endpoint)
+                lines.append('%s_sum%s %r' % (name, labels,
+                                              float(histogram[-1])))
+                lines.append('%s_count%s %d' % (name, labels, total))
+        
+        with self._lock:
+            metric('plassets_requests_total', 'counter',
+                   'Requests handled, by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(
+                    self.requests.items()):
+                lines.append('plassets_requests_total%s %d' % (
+                    prometheus_labels(endpoint=endpoint, method=method,
+                                      status=status), count))
+            
+            metric('plassets_request_duration_seconds', 'histogram',
+                   'Time to handle requests, by endpoint.')
+            histograms('plassets_request_duration_seconds', self.latencies,
+                       self.LATENCY_BUCKETS)
+            
+            metric('plassets_response_size_bytes', 'histogram',
+                   'Response body sizes, by endpoint (except for streamed '
+                   'responses).')
+            histograms('plassets_response_size_bytes', self.sizes,
+                       self.SIZE_BUCKETS)
+            
+            metric('plassets_db_pool_checkouts_total', 'counter',
+                   'Database connections checked out of the pool.')
+            lines.append('plassets_db_pool_checkouts_total %d' %
+                         self.pool_checkouts)
+        
+        # Only QueuePools have any of these
+        pools = [(prometheus_labels(**labels), pool) for labels, pool in pools
+                 if hasattr(pool, 'overflow')]
+        if pools:
+            metric('plassets_db_pool_size', 'gauge',
+                   'Connections the pool keeps open.')
+            for labels, pool in pools:
+                lines.append('plassets_db_pool_size%s %d' % (labels,
+                                                             pool.size()))
+            metric('plassets_db_pool_checked_out', 'gauge',
+                   'Connections currently checked out.')
+            for labels, pool in pools:
+                lines.append('plassets_db_pool_checked_out%s %d' % (
+                    labels, pool.checkedout()))
+            metric('plassets_db_pool_overflow', 'gauge',
+                   'Connections open beyond the pool size (negative if '
+                   'the pool is not yet full).')
+            for labels, pool in pools:
+                lines.append('plassets_db_pool_overflow%s %d' % (
+                    labels, pool.overflow()))
+        
+        if cache is not None:
+            metric('plassets_asset_cache_hits_total', 'counter',
+                   'Single asset cache hits.')
+            lines.append('plassets_asset_cache_hits_total %d' % cache.hits)
+            metric('plassets_asset_cache_misses_total', 'counter',
+                   'Single asset cache misses.')
+            lines.append('plassets_asset_cache_misses_total %d' %
+                         cache.misses)
+            metric('plassets_asset_cache_hit_ratio', 'gauge',
+                   'Fraction of single asset cache lookups that hit.')
+            lookups = cache.hits + cache.misses
+            lines.append('plassets_asset_cache_hit_ratio %r' % (
+                float(cache.hits) / lookups if lookups else 0.))
+            metric('plassets_asset_cache_entries', 'gauge',
+                   'Responses in the single asset cache.')
+            lines.append('plassets_asset_cache_entries %d' % len(cache))
+            metric('plassets_asset_cache_bytes', 'gauge',
+                   'Total size of the responses in the single asset cache.')
+            lines.append('plassets_asset_cache_bytes %d' % cache.size)
+        
+        return '\n'.join(lines) + '\n'
+
+
+def engine_pools(app):
+    ''' The pool of every engine the app uses, for Metrics.render, labeled
+    with its shard and its role (writer, or reader; see init_readers).
+    '''
+    pools = [({'shard': index, 'role': 'writer'}, engine.pool)
+             for index, engine in enumerate(shard_engines(app))]
+    
+    readers = app.extensions.get('plassets_readers')
+    if readers is not None:
+        pools.extend(({'shard': index, 'role': 'reader'}, engine.pool)
+                     for index, engine in enumerate(readers.engines))
+    
+    return pools
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    ''' Pool checkout hook for the metrics.
+    '''
+    metrics = app.extensions.get('plassets_metrics')
+    if metrics is not None:
+        metrics.observe_checkout()
+
+
+def init_metrics(app):
+    ''' (Re)create the metrics for the app, if PLASSETS_METRICS is set in
+    its config, and serve them at /metrics. Returns them (or None, if
+    they're disabled).
+    '''
+    if app.config.get('PLASSETS_METRICS', False):
+        metrics = Metrics()
+        
+        for engine in all_engines(app):
+            if not event.contains(engine, 'checkout', count_checkout):
+                event.listen(engine, 'checkout', count_checkout)
+    
+    else:
+        metrics = None
+    
+    app.extensions['plassets_metrics'] = metrics
+    return metrics
+
+
+def start_statement_timer(conn, cursor, statement, parameters, context,
+                          executemany):
+    ''' Engine before_cursor_execute hook for the query accounting. The
+    start goes on the execution context (rather than the connection), so
+    that statements that fail, and so never get to account_statement,
+    don't leave anything behind.
+    '''
+    # Only the odd internal statement (ex for column defaults) has none
+    if context is not None:
+        context._plassets_start = timeit.default_timer()
+
+
+def account_statement(conn, cursor, statement, parameters, context,
+                      executemany):
+    ''' Engine after_cursor_execute hook for the query accounting. Adds
+    the statement to the totals for the current request (if any), and
+    logs it if it was slower than PLASSETS_SLOW_QUERY_SECONDS.
+    '''
+    start = getattr(context, '_plassets_start', None)
+    if start is None:
+        return
+    
+    elapsed = timeit.default_timer() - start
+    
+    if has_request_context():
+        g.plassets_query_count = g.get('plassets_query_count', 0) + 1
+        g.plassets_db_time = g.get('plassets_db_time', 0) + elapsed
+        route = '%s %s' % (request.method, request.path)
+    else:
+        route = None
+    
+    threshold = app.config.get('PLASSETS_SLOW_QUERY_SECONDS')
+    if threshold is not None and elapsed >= threshold:
+        # executemany parameters can be enormous; the first set will do
+        if executemany:
+            parameters = '%r (and %d more)' % (parameters[0],
+                                               len(parameters) - 1)
+        
+        sql_logger.warning('Slow statement (%.3fs) for %s: %s; parameters: %s',
+                           elapsed, route, statement, parameters)
+
+
+def init_query_accounting(app):
+    ''' Make sure the app's engines count and time every statement, per
+    request. In debug mode, the totals are returned in the X-Query-Count
+    and X-DB-Time (seconds) headers.
+    '''
+    for engine in all_engines(app):
+        if not event.contains(engine, 'before_cursor_execute',
+                              start_statement_timer):
+            event.listen(engine, 'before_cursor_execute',
+                         start_statement_timer)
+            event.listen(engine, 'after_cursor_execute', account_statement)
+
 
 # Misc helpers
-NAME_PATTERN = re.compile(r'^[A-z0-9][A-z0-9\_\-]{3,63}$')
+# Not [A-z], which also matches _, [, ^, etc: names starting with an
+# underscore are reserved for routes like _stats and _bulk. And \Z, not $,
+# which also matches before a trailing newline. (Same for the others.)
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9\_\-]{3,63}\Z')
+# The start of a valid name (for name_prefix)
+NAME_PREFIX_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9\_\-]{0,63}\Z')
+# Upper bound on ?limit=; bigger requests are silently clamped to this
+MAX_PAGE_SIZE = 1000
+# How many rows to pull from the db (and write to the client) at a time when
+# streaming listings
+STREAM_BATCH_SIZE = 1000
+CURSOR_PATTERN = re.compile(r'^[A-Za-z0-9\_\-]+\Z')
+# Everything that Asset construction raises for bad input
+BAD_ASSET_ERRORS = (KeyError, AttributeError, ValueError, TypeError)
+# SQLite limits the number of bound parameters per statement (999 on older
+# versions), so big IN (...) clauses need to be chunked
+MAX_IN_PARAMS = 500
+# Comparisons available for detail query args
+DETAIL_OPERATORS = {
+    '': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+# Indexes from earlier versions of the schema, which upgrade_db will drop
+OBSOLETE_INDEXES = ('ix_assets_type', 'ix_assets_class')
+
+
+def dump_details(details):
+    ''' Canonical json for asset details, as stored in the database.
+    Because this is compact and key-sorted, it can be spliced verbatim
+    into responses; see serialize_asset.
+    '''
+    # Not NaN or Infinity, which aren't json (and which sqlite's json
+    # functions, and therefore the detail indexes, reject)
+    return json.dumps(details, sort_keys=True, separators=(',', ':'),
+                      allow_nan=False)
+
+
+def serialize_asset(name, asset_type, asset_class, details):
+    ''' Build the json for an asset straight from its columns (equivalent
+    to json.dumps(asset.dictify()), but much faster). The details are
+    already json, so instead of parsing them just to dump them again, we
+    splice them in as-is.
+    '''
+    return '{"class":%s,"details":%s,"name":%s,"type":%s}' % (
+        json.dumps(asset_class),
+        details or '{}',
+        json.dumps(name),
+        json.dumps(asset_type)
+    )
+
+
+def field_serializer(fields):
+    ''' Build the equivalent of serialize_asset for only some of the
+    fields (in sorted order). The returned function takes a row of the
+    name, followed by the columns for those fields.
+    '''
+    template = '{' + ','.join('"%s":%%s' % field for field in fields) + '}'
+    encoders = [(lambda details: details or '{}') if field == 'details'
+                else json.dumps for field in fields]
+    
+    def serialize(row):
+        return template % tuple(
+            encode(value) for encode, value in zip(encoders, row[1:]))
+    
+    return serialize
+
+
+def check_detail(value, cls):
+    ''' Check a detail value against its cls, raising TypeError if it's
+    the wrong type, and ValueError if it's a float that json can't
+    represent (NaN, or infinite; ex 1e400).
+    '''
+    if not isinstance(value, cls):
+        raise TypeError(repr(value) + ' is not ' + repr(cls))
+    elif isinstance(value, float) and (math.isnan(value) or
+                                       math.isinf(value)):
+        raise ValueError(value)
+
+
+DetailSpec = collections.namedtuple(
+    'DetailSpec', ['asset_type', 'asset_class', 'name', 'cls'])
+# All declared details, by name; see asset_detail
+DETAILS = {}
 
 
 def asset_detail(asset_type, asset_class, name, cls):
     ''' Creates a detail with the given name and the supplied cls,
     specific to the passed type and class.
     '''
+    # Details are queryable by name (see compile_filters), so names need to be
+    # unique across all types and classes
+    if name in DETAILS:
+        raise ValueError('Duplicate detail name: ' + name)
+    DETAILS[name] = DetailSpec(asset_type, asset_class, name, cls)
         
     @hybrid_property
     def detail(self):
@@ -99,7 +876,7 @@ def asset_detail(asset_type, asset_class, name, cls):
         
         else:
             try:
-                return json.loads(self._details)[name]
+                return self.decoded_details[name]
             
             except KeyError:
                 raise AttributeError(name)
@@ -115,19 +892,15 @@ def asset_detail(asset_type, asset_class, name, cls):
             raise AttributeError(name)
         
         # Error trap: detail value doesn't match spec
-        elif not isinstance(value, cls):
-            raise TypeError(repr(value) + ' is not ' + repr(cls))
-        
-        # On-the-fly generation of json, so that we have a single source of
-        # truth. Alternatively we could modify the sqlalchemy "magic", but this
-        # is easier for a demo app / MVP
-        if self._details:
-            details = json.loads(self._details)
-        else:
-            details = {}
+        check_detail(value, cls)
         
-        details[name] = value
-        self._details = json.dumps(details)
+        # Only update the decoded details here; they're dumped back into
+        # _details once, at flush (see sync_details), instead of on every
+        # single assignment
+        self.decoded_details[name] = value
+        self._details_stale = True
+        # Make sure the session notices us, even though no column changed
+        flag_dirty(self)
         
     return detail
     
@@ -179,6 +952,9 @@ WHATSITS = '''
                         400: function() {
                             alert('Failure!')
                         },
+                        409: function() {
+                            alert('That name is already taken!')
+                        },
                         401: function() {
                             alert('Unauthenticated... you modified the page?')
                         }
@@ -223,11 +999,23 @@ class Asset(db.Model):
                       unique=True, index=True)
     # These are probably bigger than they need to be, but unless we're planning
     # on having hundreds of millions of assets... might as well have headroom
-    _asset_type = db.Column('type', db.String(128), nullable=False, index=True)
-    _asset_class = db.Column('class', db.String(128), nullable=False,
-                             index=True)
+    _asset_type = db.Column('type', db.String(128), nullable=False)
+    _asset_class = db.Column('class', db.String(128), nullable=False)
     # Just store details as a nullable json blob
     _details = db.Column('details', db.Text)
+    # The parsed _details, loaded lazily; see decoded_details. If stale,
+    # there are changes here that haven't made it into _details yet.
+    _decoded_details = None
+    _details_stale = False
+    
+    # Every listing is ordered by name, so (unlike indexes on just the type or
+    # class) these let filtered listings come straight out of the index,
+    # without a sort. They also cover plain type/class lookups. Update
+    # upgrade_db if these change!
+    __table_args__ = (
+        db.Index('ix_assets_type_name', 'type', 'name'),
+        db.Index('ix_assets_class_name', 'class', 'name'),
+    )
     
     VALID_TYPES = {'antenna', 'satellite'}
     VALID_CLASSES = {
@@ -238,18 +1026,17 @@ class Asset(db.Model):
     def __init__(self, name, asset_type, asset_class, **details):
         ''' Create an asset.
         '''
-        # If the order of these being declared changes, we will need to add
-        # immutability checks to asset types and classes
-        self.name = name
-        self.asset_type = asset_type
-        self.asset_class = asset_class
+        validate_asset(name, asset_type, asset_class, details)
         
-        # Quick and dirty enforcing that **details are, in fact, details
-        if any(key not in dir(Asset) for key in details):
-            raise AttributeError()
+        # Everything's already been checked, so skip the setters (and their
+        # redundant checks)
+        self._name = name
+        self._asset_type = asset_type
+        self._asset_class = asset_class
         
-        for key, value in details.items():
-            setattr(self, key, value)
+        if details:
+            self._decoded_details = dict(details)
+            self._details_stale = True
         
     @hybrid_property
     def name(self):
@@ -260,8 +1047,11 @@ class Asset(db.Model):
     @name.setter
     def name(self, value):
         ''' Set the name, checking it for validity on the way. Also,
-        ensure immutability, both locally (for this instance) and in the
-        database.
+        ensure immutability locally (for this instance).
+        
+        Uniqueness in the database is left to the primary key constraint:
+        inserting a duplicate raises an IntegrityError on flush. Checking
+        here would cost a query per asset, and race with other writers.
         '''
         if self._name:
             raise AttributeError('Cannot mutate names.')
@@ -270,12 +1060,6 @@ class Asset(db.Model):
         if not re.match(NAME_PATTERN, value):
             raise ValueError(value)
         
-        # Ensure uniqueness (there's a small race condition here, but I'm
-        # assuming asset creation will be slow enough for it to be ignored)
-        q = db.session.query(Asset).filter(Asset._name == value)
-        if db.session.query(q.exists()).scalar():
-            raise ValueError(value)
-            
         self._name = value
         
     @hybrid_property
@@ -288,7 +1072,7 @@ class Asset(db.Model):
     def asset_type(self, value):
         ''' Set the asset type, checking it for validity. Also ensure
         immutability of both instance (database immutability is handled
-        through the name check).
+        through the name's primary key constraint).
         '''
         if self._asset_type:
             raise AttributeError('Cannot mutate asset type.')
@@ -309,7 +1093,7 @@ class Asset(db.Model):
     def asset_class(self, value):
         ''' Set the asset class, checking it for validity. Also ensure
         immutability of both instance (database immutability is handled
-        through the name check).
+        through the name's primary key constraint).
         '''
         if self._asset_class:
             raise AttributeError('Cannot mutate asset class.')
@@ -327,6 +1111,23 @@ class Asset(db.Model):
     diameter = asset_detail('antenna', 'dish', 'diameter', float)
     radome = asset_detail('antenna', 'dish', 'radome', bool)
     
+    @property
+    def decoded_details(self):
+        ''' The details, as a dict. These are only parsed from json once
+        per instance (well, once per load from the database), no matter
+        how many details are read or assigned.
+        
+        Modifying this directly bypasses detail validation, and won't be
+        saved.
+        '''
+        if self._decoded_details is None:
+            if self._details:
+                self._decoded_details = json.loads(self._details)
+            else:
+                self._decoded_details = {}
+        
+        return self._decoded_details
+    
     # As a utility function...
     def dictify(self):
         ''' Convert self to json-parseable dict. Could also define a
@@ -335,21 +1136,868 @@ class Asset(db.Model):
         # If this were larger, it might make sense to do this programmatically,
         # but it doesn't make sense with only 4 columns, especially with the
         # name remapping.
-        if self._details:
-            # Lulz this is awkward...
-            details = json.loads(self._details)
-        else:
-            details = {}
-        
+        # (If you're just going to dump this to json, use serialize_asset
+        # instead)
         return {
             'name': self.name,
             'type': self.asset_type,
             'class': self.asset_class,
-            'details': details
+            'details': dict(self.decoded_details)
         }
+    
+    @classmethod
+    def from_json(cls, data):
+        ''' Create an asset from its (already-parsed) json form. Raises
+        one of BAD_ASSET_ERRORS if it's invalid.
+        '''
+        # **details is quick+snazzy and I like it. Though, in reality, it's
+        # unsafe, because a malicious user could pass in, for example,
+        # '__dict__': 'foo' in the JSON. But, for MVP with authenticated users,
+        # this should be good enough (json is safe, so worst-case, it would
+        # crash the server)
+        name = data['name']
+        asset_type = data['type']
+        asset_class = data['class']
+        details = data['details']
+        return cls(name, asset_type, asset_class, **details)
+
+
+def detail_validator(schema):
+    ''' Create a function that checks asset details against the passed
+    schema, a dict of {detail name: detail cls}.
+    '''
+    def validate(details):
+        for key, value in details.items():
+            try:
+                cls = schema[key]
+            except KeyError:
+                raise AttributeError(key)
+            
+            check_detail(value, cls)
+    
+    return validate
+
+
+def compile_validators():
+    ''' Build a detail validator for every valid (type, class) pair, per
+    the details declared on Asset.
+    '''
+    validators = {}
+    for asset_type, asset_classes in Asset.VALID_CLASSES.items():
+        for asset_class in asset_classes:
+            schema = {spec.name: spec.cls for spec in DETAILS.values()
+                      if spec.asset_type == asset_type and
+                      spec.asset_class == asset_class}
+            validators[asset_type, asset_class] = detail_validator(schema)
+    
+    return validators
+
+
+# Detail validators for every valid (type, class) pair
+VALIDATORS = compile_validators()
+
+
+def validate_asset(name, asset_type, asset_class, details):
+    ''' Check everything about a prospective asset in one go, raising
+    just like Asset would: ValueError for a bad name, type or class (or
+    a non-finite float detail), AttributeError for an unknown detail, and
+    TypeError for a detail of the wrong type. This doesn't check that the name is unused.
+    '''
+    if not NAME_PATTERN.match(name):
+        raise ValueError(name)
+    
+    # Unknown (or unhashable) types and classes won't be in here
+    try:
+        validator = VALIDATORS[asset_type, asset_class]
+    except (KeyError, TypeError):
+        raise ValueError((asset_type, asset_class))
+    
+    validator(details)
+
+
+def detail_column(name):
+    ''' The sql expression for the value of the named detail (null if
+    the asset doesn't have it). The json path is a literal instead of a
+    bound parameter, so that sqlite can match it against the detail
+    indexes.
+    '''
+    return sqlalchemy.func.json_extract(
+        Asset.__table__.c.details,
+        sqlalchemy.literal_column("'$.%s'" % name)
+    )
+
+
+# Expression indexes for searching by detail values. These lead with the
+# class (all queries for a detail are restricted to the class that has it),
+# and end with the name, so equality matches don't need sorting.
+for spec in DETAILS.values():
+    db.Index(
+        'ix_assets_%s_%s' % (spec.asset_class, spec.name),
+        Asset.__table__.c['class'],
+        detail_column(spec.name),
+        Asset.__table__.c.name
+    )
+
+
+# Every class, of every type
+ALL_CLASSES = set().union(*Asset.VALID_CLASSES.values())
+# The arguments to serialize_asset, in order
+SERIALIZED_COLUMNS = (Asset._name, Asset._asset_type, Asset._asset_class,
+                      Asset._details)
+# The column for each field that can be requested with fields=
+FIELD_COLUMNS = {
+    'class': Asset._asset_class,
+    'details': Asset._details,
+    'name': Asset._name,
+    'type': Asset._asset_type,
+}
+
+
+class AssetCount(db.Model):
+    ''' How many assets there are of each type and class. Assets are never
+    deleted, so these only ever go up; count_new_assets keeps them current
+    as part of the same transaction as the assets themselves.
+    '''
+    __tablename__ = 'asset_counts'
+    asset_type = db.Column('type', db.String(128), primary_key=True)
+    asset_class = db.Column('class', db.String(128), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(db.session, 'before_flush')
+def sync_details(session, flush_context, instances):
+    ''' Dump any assets' changed details back into their json column.
+    '''
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Asset) and obj._details_stale:
+            obj._details = dump_details(obj._decoded_details)
+            obj._details_stale = False
+
+
+@event.listens_for(Asset, 'refresh')
+def forget_decoded_details(target, context, attrs):
+    ''' The json column may have changed in the database, so the decoded
+    details need to be parsed from scratch.
+    '''
+    if attrs is None or '_details' in attrs:
+        target._decoded_details = None
+        target._details_stale = False
+
+
+def add_asset_counts(conn, counts):
+    ''' Add {(type, class): count} to the asset counts, using conn (a
+    session or a connection). This must be in the same transaction as
+    the inserts it's counting, after at least one of them, so that it
+    already holds the write lock.
+    '''
+    table = AssetCount.__table__
+    
+    for (asset_type, asset_class), count in counts.items():
+        where = sqlalchemy.and_(table.c['type'] == asset_type,
+                                table.c['class'] == asset_class)
+        result = conn.execute(
+            table.update().where(where).values(count=table.c.count + count))
         
+        # The first of its kind. We already hold the write lock, so nobody
+        # else can have inserted it in the meantime.
+        if result.rowcount == 0:
+            conn.execute(table.insert().values(
+                {'type': asset_type, 'class': asset_class, 'count': count}))
+
+
+@event.listens_for(db.session, 'after_flush')
+def count_new_assets(session, flush_context):
+    ''' Add any newly-inserted assets to the asset counts. Since this runs
+    inside the flush's transaction, the counts are committed (or rolled
+    back) along with the assets.
+    '''
+    counts = collections.Counter(
+        (obj._asset_type, obj._asset_class) for obj in session.new
+        if isinstance(obj, Asset)
+    )
+    add_asset_counts(session, counts)
+
+
+@event.listens_for(db.session, 'after_flush')
+def note_asset_writes(session, flush_context):
+    ''' Remember if the flush wrote any assets, so that we can bump the
+    store version when (if) it's committed.
+    '''
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Asset):
+            session.info['plassets_asset_writes'] = True
+            break
+
+
+@event.listens_for(db.session, 'after_commit')
+def bump_store_version(session):
+    ''' Bump the store version if the commit included any asset writes.
+    '''
+    if session.info.pop('plassets_asset_writes', False):
+        version = app.extensions.get('plassets_version')
+        if version is not None:
+            version.bump()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_asset_writes(session):
+    session.info.pop('plassets_asset_writes', None)
+
+
+# The hooks above are only for db.session. Every other session that writes
+# assets (see Shards) needs them too.
+SESSION_HOOKS = (
+    ('before_flush', sync_details),
+    ('after_flush', count_new_assets),
+    ('after_flush', note_asset_writes),
+    ('after_commit', bump_store_version),
+    ('after_rollback', forget_asset_writes),
+)
+
+
+def upgrade_db():
+    ''' Bring an existing database (every shard of it) up to date with
+    the current schema: create_all creates missing tables, but won't
+    touch the indexes of existing ones. Safe to run on any database, old
+    or new.
+    '''
+    for engine in shard_engines(app):
+        upgrade_engine(engine)
+
+
+def upgrade_engine(engine):
+    ''' upgrade_db, for a single engine.
+    '''
+    db.Model.metadata.create_all(bind=engine)
+    
+    # Not sqlalchemy.inspect, because it skips expression indexes
+    existing = {name for name, in engine.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'index' AND tbl_name = 'assets'"
+    )}
+    for index in Asset.__table__.indexes:
+        if index.name not in existing:
+            index.create(bind=engine)
+    
+    # Superseded by the composite indexes, and if they exist, the query
+    # planner might pick them (and then sort) instead
+    for name in OBSOLETE_INDEXES:
+        if name in existing:
+            engine.execute('DROP INDEX %s' % name)
+    
+    # The database might predate the counts (or have been written to by
+    # something that doesn't keep them), so rebuild them from scratch
+    rebuild_asset_counts(engine)
+
+
+def rebuild_asset_counts(engine=None):
+    ''' Recount every asset, by type and class, on the passed engine (by
+    default the app's main one). This is a full scan, so it's only for
+    startup; afterwards, count_new_assets keeps them current.
+    '''
+    counts = AssetCount.__table__
+    assets = Asset.__table__
+    
+    if engine is None:
+        engine = db.get_engine()
+    
+    with engine.begin() as conn:
+        conn.execute(counts.delete())
+        conn.execute(counts.insert().from_select(
+            ['type', 'class', 'count'],
+            sqlalchemy.select([assets.c['type'], assets.c['class'],
+                               sqlalchemy.func.count()]).group_by(
+                assets.c['type'], assets.c['class'])
+        ))
+
+
+def snapshot_db(path):
+    ''' Write a consistent copy of the database to path with sqlite's
+    online backup api, which works while the database is in use (python
+    3.7+). The copy is written next to path and then moved into place, so
+    path is always a complete snapshot, old or new.
+    
+    Sharded stores get a snapshot per shard (see shard_path). Each one is
+    consistent, but they aren't taken at exactly the same moment.
+    '''
+    for index, engine in enumerate(shard_engines(app)):
+        snapshot_engine(engine, shard_path(path, index))
+
+
+def snapshot_engine(engine, path):
+    ''' snapshot_db, for a single engine.
+    '''
+    partial = path + '.partial'
+    raw = engine.raw_connection()
+    try:
+        target = sqlite3.connect(partial)
+        try:
+            # In a single step, so it's all from one read transaction. In
+            # smaller steps, every write in between would restart it.
+            raw.connection.backup(target)
+        finally:
+            target.close()
+    
+    finally:
+        raw.close()
+    
+    os.replace(partial, path)
+
+
+def restore_snapshot(snapshot, path, shards=1):
+    ''' Replace the contents of the database at path (and its shards, if
+    there are more than one) with a snapshot from snapshot_db. Do this
+    before create_app, while nothing else has the database open.
+    
+    Raises IOError if the snapshot (or any of its shards) is missing,
+    before touching anything.
+    '''
+    # Otherwise, sqlite3.connect would happily create an empty one, and
+    # we'd "restore" that
+    for index in range(shards):
+        source = shard_path(snapshot, index)
+        if not os.path.isfile(source):
+            raise IOError('No such snapshot: ' + source)
+    
+    for index in range(shards):
+        source = sqlite3.connect(shard_path(snapshot, index))
+        try:
+            target = sqlite3.connect(shard_path(path, index))
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        
+        finally:
+            source.close()
+
+
+def shard_session(name):
+    ''' The session for the shard that the named asset belongs on.
+    '''
+    shards = app.extensions.get('plassets_shards')
+    if shards is None:
+        return db.session
+    else:
+        return shards.session_for(name)
+
+
+def group_by_shard(names):
+    ''' Split up names by shard. Returns a list of (session, names), for
+    only the shards that have any.
+    '''
+    shards = app.extensions.get('plassets_shards')
+    if shards is None:
+        return [(db.session, list(names))]
+    
+    groups = collections.defaultdict(list)
+    for name in names:
+        groups[shard_index(name, len(shards))].append(name)
+    
+    return [(shards.sessions[index], groups[index])
+            for index in sorted(groups)]
+
+
+def read_session(name):
+    ''' The session to read the named asset through: its shard's reader,
+    if there are readers, or else the same session that writes it.
+    '''
+    readers = app.extensions.get('plassets_readers')
+    if readers is None:
+        return shard_session(name)
+    else:
+        return readers.session_for(name)
+
+
+def scatter(q):
+    ''' The copy of a query for every shard (just the one, if unsharded),
+    to read through the readers, if there are any.
+    '''
+    readers = app.extensions.get('plassets_readers')
+    shards = app.extensions.get('plassets_shards')
+    if readers is not None:
+        sessions = readers.sessions
+    elif shards is not None:
+        sessions = shards.sessions
+    else:
+        return [q]
+    
+    return [q.with_session(session()) for session in sessions]
+
+
+def gather(results):
+    ''' Merge name-ordered rows (that start with the name) from each shard
+    into a single name-ordered iterable. Since every name is on exactly
+    one shard, the rows never compare past the name.
+    '''
+    if len(results) == 1:
+        return results[0]
+    else:
+        return heapq.merge(*results)
+
+
+def existing_names(names):
+    ''' Return the set of the passed names that are already taken,
+    using a single query (per MAX_IN_PARAMS names, per shard).
+    '''
+    taken = set()
+    
+    for session, names in group_by_shard(names):
+        for ii in range(0, len(names), MAX_IN_PARAMS):
+            chunk = names[ii:ii + MAX_IN_PARAMS]
+            q = session.query(Asset._name).filter(Asset._name.in_(chunk))
+            taken.update(name for name, in q)
+    
+    return taken
+
+
+def bulk_names(data):
+    ''' The names in a _bulk request (a list), in order. Anything
+    without a usable name (which will fail validation anyways) is None.
+    '''
+    names = [item.get('name') if isinstance(item, dict) else None
+             for item in data]
+    return [name if isinstance(name, type(u'')) else None for name in names]
+
+
+def triage_bulk(names, data, taken):
+    ''' Sort a _bulk request into the assets to create, and the status of
+    every item. Names in the taken set (which is updated in place) are
+    conflicts. Returns (results, assets).
+    '''
+    results = []
+    assets = []
+    for name, item in zip(names, data):
+        if name in taken:
+            results.append({'name': name, 'status': 409})
+            continue
+        
+        try:
+            asset = Asset.from_json(item)
         
+        except BAD_ASSET_ERRORS:
+            results.append({'name': name, 'status': 400})
+            continue
+        
+        # Also catch repeats within this batch
+        taken.add(name)
+        assets.append(asset)
+        results.append({'name': name, 'status': 200})
+    
+    return results, assets
+
+
+def asset_columns(asset):
+    ''' The column values of a new asset, in the same order as
+    SERIALIZED_COLUMNS, for writing it without going through the session.
+    '''
+    if asset._details_stale:
+        details = dump_details(asset._decoded_details)
+    else:
+        details = asset._details
+    
+    return asset._name, asset._asset_type, asset._asset_class, details
+
+
+def summarize_counts(rows):
+    ''' Total up rows of (type, class, count) into the _stats response.
+    '''
+    types = dict.fromkeys(Asset.VALID_TYPES, 0)
+    classes = dict.fromkeys(ALL_CLASSES, 0)
+    
+    for asset_type, asset_class, count in rows:
+        types[asset_type] = types.get(asset_type, 0) + count
+        classes[asset_class] = classes.get(asset_class, 0) + count
+    
+    return {
+        'classes': classes,
+        'total': sum(types.values()),
+        'types': types
+    }
+
+
+def encode_cursor(name):
+    ''' Cursors are opaque to clients, but they're really just the name
+    of the last asset on the previous page.
+    '''
+    cursor = base64.urlsafe_b64encode(name.encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    ''' Inverse of encode_cursor. Garbage cursors are a 400.
+    '''
+    # b64decode silently drops junk characters, so check them up front
+    if not CURSOR_PATTERN.match(cursor):
+        abort(400)
+
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+    
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        abort(400)
+
+
+def page_limit(args):
+    ''' Parse the limit arg. Returns None if there isn't one.
+    '''
+    limit = args.get('limit')
+    if limit is None:
+        return None
+    
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def after_cursor(q):
+    ''' Skip everything up to and including the cursor request arg, if
+    there is one.
+    '''
+    cursor = request.args.get('cursor')
+    
+    if cursor is None:
+        return q
+    else:
+        return q.filter(Asset._name > decode_cursor(cursor))
+
+
+def paginate(q):
+    ''' Apply keyset pagination to a name-ordered asset query, per the
+    limit and cursor request args. Returns the page of rows, and the
+    cursor for the next page (None if this is the last one). The rows
+    must start with the name.
+    
+    We page on the name (our primary key) instead of using OFFSET, so
+    that page N costs the same as page 1.
+    '''
+    queries = scatter(after_cursor(q))
+    limit = page_limit(request.args)
+    
+    # No limit means "everything", for backwards compatibility
+    if limit is None:
+        return list(gather([q.all() for q in queries])), None
+    
+    # Grab one extra row so we know if there's a next page at all. Every
+    # shard might have the whole page, so they all need to fetch that much.
+    rows = list(itertools.islice(
+        gather([q.limit(limit + 1).all() for q in queries]), limit + 1))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][0])
+    else:
+        return rows, None
+
+
+def wants_ndjson():
+    ''' Did the client explicitly ask for newline-delimited json?
+    '''
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def stream_listing(q, ndjson, serialize):
+    ''' Stream a name-ordered asset query to the client, without ever
+    holding the whole result in memory. Either a json array (sent in
+    chunks) or ndjson, one asset per line.
+    
+    The cursor and limit args still apply, but there's no X-Next-Cursor:
+    we don't know if there's another page until we've already sent
+    the headers.
+    
+    Every batch is its own (keyset-paginated) query, read all at once,
+    so a slow client never holds a cursor open while we wait for it.
+    Without a write-ahead log, that would hold a read lock, and block
+    every writer until the download finished.
+    '''
+    queries = scatter(after_cursor(q))
+    limit = page_limit(request.args)
+    
+    if ndjson:
+        mimetype = 'application/x-ndjson'
+        head, tail = '', ''
+        
+        def render(chunk, first):
+            return '\n'.join(chunk) + '\n'
+    
+    else:
+        mimetype = 'application/json'
+        head, tail = '[', ']\n'
+        
+        def render(chunk, first):
+            return ('' if first else ',') + ','.join(chunk)
+    
+    def generate():
+        # Send *something* immediately, so time-to-first-byte doesn't
+        # depend on the query
+        yield head
+        
+        remaining = limit
+        batches = queries
+        first = True
+        while remaining is None or remaining > 0:
+            batch_size = STREAM_BATCH_SIZE
+            if remaining is not None:
+                batch_size = min(batch_size, remaining)
+                remaining -= batch_size
+            
+            # The next batch from every shard, merged; the first batch_size
+            # of those are the next batch overall
+            rows = list(itertools.islice(
+                gather([q.limit(batch_size).all() for q in batches]),
+                batch_size))
+            if rows:
+                yield render([serialize(row) for row in rows], first)
+                first = False
+            
+            if len(rows) < batch_size:
+                break
+            batches = [q.filter(Asset._name > rows[-1][0]) for q in queries]
+        
+        yield tail
+    
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def parse_fields(args):
+    ''' Parse the fields arg (repeatable, or comma-separated) into a
+    sorted list of field names. Returns None if there isn't one (meaning
+    every field); unknown fields are a 400.
+    '''
+    fields = set(multi_arg(args, 'fields'))
+    if not fields:
+        return None
+    elif not fields <= set(FIELD_COLUMNS):
+        abort(400)
+    
+    return sorted(fields)
+
+
+def projection(fields):
+    ''' The columns to select for the given fields (see parse_fields),
+    and the function to serialize each resulting row. The name always
+    comes first, even if it wasn't asked for, because pagination needs
+    it.
+    
+    Only the requested columns are selected, so unless the details are
+    asked for, they never even get read from the database.
+    '''
+    if fields is None:
+        return SERIALIZED_COLUMNS, lambda row: serialize_asset(*row)
+    
+    # Labelled, because a plain select would collapse fields=name into the
+    # leading name column
+    columns = [Asset._name] + [FIELD_COLUMNS[field].label(field)
+                               for field in fields]
+    return columns, field_serializer(fields)
+
+
+def parse_detail_arg(spec, value):
+    ''' Convert a detail query arg to the detail's type. Bad values are a
+    400.
+    '''
+    if spec.cls is bool:
+        if value.lower() in ('true', '1'):
+            return True
+        elif value.lower() in ('false', '0'):
+            return False
+    
+    else:
+        try:
+            return spec.cls(value)
+        except ValueError:
+            pass
+    
+    abort(400)
+
+
+def multi_arg(args, key):
+    ''' Get all values of a repeatable (or comma-separated) arg.
+    '''
+    values = []
+    for value in args.getlist(key):
+        values.extend(value.split(','))
+    return [value for value in values if value]
+
+
+def compile_filters(args):
+    ''' Compile the filter args into a list of sqlalchemy criteria, all
+    of which must hold:
+    
+    +   type: the asset type must be one of these
+    +   class: the asset class must be one of these
+    +   name_prefix: the asset name must start with this
+    +   <detail>: the named detail must equal this (ex: radome=true)
+    +   <detail>__<op>: the named detail must compare to this, per op (one
+        of ne, gt, gte, lt, lte; ex: diameter__gt=9.0)
+    
+    type and class can be repeated (or comma-separated). Unknown types or
+    classes, name prefixes that no name could start with, or bad detail
+    values, are a 400.
+    '''
+    criteria = []
+    
+    asset_types = multi_arg(args, 'type')
+    if any(value not in Asset.VALID_TYPES for value in asset_types):
+        abort(400)
+    elif len(asset_types) == 1:
+        criteria.append(Asset._asset_type == asset_types[0])
+    elif asset_types:
+        criteria.append(Asset._asset_type.in_(asset_types))
+    
+    asset_classes = multi_arg(args, 'class')
+    if any(value not in ALL_CLASSES for value in asset_classes):
+        abort(400)
+    elif len(asset_classes) == 1:
+        criteria.append(Asset._asset_class == asset_classes[0])
+    elif asset_classes:
+        criteria.append(Asset._asset_class.in_(asset_classes))
+    
+    # As a range instead of a LIKE, so that it can use the index. Within
+    # the name alphabet, the last character always has a successor.
+    prefix = args.get('name_prefix')
+    if prefix and not NAME_PREFIX_PATTERN.match(prefix):
+        abort(400)
+    elif prefix:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        criteria.append(Asset._name >= prefix)
+        criteria.append(Asset._name < upper)
+    
+    for key in args:
+        name, __, op = key.partition('__')
+        if name not in DETAILS:
+            continue
+        elif op not in DETAIL_OPERATORS:
+            abort(400)
+        
+        spec = DETAILS[name]
+        criteria.append(Asset._asset_class == spec.asset_class)
+        for value in args.getlist(key):
+            value = parse_detail_arg(spec, value)
+            criteria.append(DETAIL_OPERATORS[op](detail_column(name), value))
+    
+    return criteria
+
+
+def list_assets(asset_type=None, asset_class=None):
+    ''' The (name-ordered) listing for the filter args in the request,
+    optionally restricted further to a single type and/or class.
+    '''
+    criteria = compile_filters(request.args)
+    
+    if asset_type is not None:
+        criteria.append(Asset._asset_type == asset_type)
+    if asset_class is not None:
+        criteria.append(Asset._asset_class == asset_class)
+    
+    q = Asset.query.filter(*criteria).order_by(Asset.name)
+    return asset_listing(q)
+
+
+def asset_listing(q):
+    ''' Build the json response for a name-ordered asset query. If there
+    are more assets, the cursor for the next page is in X-Next-Cursor.
+    
+    Pass stream=1 (or Accept: application/x-ndjson) to stream the
+    response instead, and fields to only get some of each asset's fields
+    (ex: fields=name,class).
+    '''
+    # We never need the actual Asset objects, just their columns
+    columns, serialize = projection(parse_fields(request.args))
+    q = q.with_entities(*columns)
+    
+    ndjson = wants_ndjson()
+    if ndjson or request.args.get('stream') in ('1', 'true'):
+        return stream_listing(q, ndjson, serialize)
+    
+    rows, next_cursor = paginate(q)
+    response = Response(
+        '[' + ','.join(serialize(row) for row in rows) + ']\n',
+        mimetype='application/json'
+    )
+    
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    
+    return response
+
+
+@app.teardown_appcontext
+def remove_shard_sessions(exc):
+    # Like flask_sqlalchemy does for db.session
+    for key in ('plassets_shards', 'plassets_readers'):
+        sessions = app.extensions.get(key)
+        if sessions is not None:
+            sessions.remove()
+
+
+@app.before_request
+def start_request_timer():
+    if app.extensions.get('plassets_metrics') is not None:
+        g.plassets_start = timeit.default_timer()
+
+
+@app.before_request
+def reset_query_accounting():
+    # The app context (and therefore g) can outlive the request
+    g.plassets_query_count = 0
+    g.plassets_db_time = 0
+
+
+@app.after_request
+def record_request_metrics(response):
+    metrics = app.extensions.get('plassets_metrics')
+    start = g.get('plassets_start')
+    
+    if metrics is not None and start is not None:
+        # Streamed responses only know their size if they say so up front
+        # (error pages do); buffering the rest just to measure it isn't
+        # worth it.
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = len(response.get_data())
+        metrics.observe_request(
+            request.endpoint or 'none', request.method,
+            response.status_code, timeit.default_timer() - start, size)
+    
+    return response
+
+
+@app.after_request
+def add_query_headers(response):
+    # Streamed responses keep querying after this, so they'll under-count
+    if app.debug:
+        response.headers['X-Query-Count'] = str(g.plassets_query_count)
+        response.headers['X-DB-Time'] = '%.6f' % g.plassets_db_time
+    
+    return response
+
+
+@app.route('/metrics')
+def show_metrics():
+    ''' Get the app's metrics, in the Prometheus text format, if they're
+    enabled (see init_metrics).
+    '''
+    metrics = app.extensions.get('plassets_metrics')
+    if metrics is None:
+        abort(404)
+    
+    return Response(
+        metrics.render(engine_pools(app),
+                       app.extensions.get('plassets_asset_cache')),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 @app.route('/')
+@versioned
 def show_silly_make():
     return WHATSITS
 
@@ -361,102 +2009,209 @@ def make_new_asset():
     '''
     data = request.get_json(force=True)
     
-    # **details is quick+snazzy and I like it. Though, in reality, it's unsafe,
-    # because a malicious user could pass in, for example, '__dict__': 'foo'
-    # in the JSON. But, for MVP with authenticated users, this should be good
-    # enough (json is safe, so worst-case, it would crash the server)
     try:
-        name = data.pop('name')
-        asset_type = data.pop('type')
-        asset_class = data.pop('class')
-        details = data.pop('details')
-        asset = Asset(name, asset_type, asset_class, **details)
+        asset = Asset.from_json(data)
     
-    except (KeyError, AttributeError, ValueError, TypeError):
+    except BAD_ASSET_ERRORS:
         abort(400)
     
-    db.session.add(asset)
-    db.session.commit()
+    # The name is our primary key, so the database enforces uniqueness. (If
+    # we're sharded, every name only ever goes on one shard, so that still
+    # holds.)
+    session = shard_session(asset.name)
+    session.add(asset)
+    try:
+        session.commit()
+    
+    except IntegrityError:
+        session.rollback()
+        abort(409)
+    
+    # Whatever it was, don't leave the session unusable for the next request
+    # that gets it (which, if the app context outlives the request, is the
+    # next one on this thread)
+    except Exception:
+        session.rollback()
+        raise
+    
     return Response(status=200)
 
 
+@app.route('/assets/v1/_bulk', methods=['POST'])
+@admin_required
+def make_new_assets():
+    ''' Make many new assets at once, per a json list of requests in the
+    same form as for make_new_asset. The valid ones are all created in a
+    single transaction; the response is a list of the status of every
+    one, in order, like this:
+    
+    [{"name": "fooz", "status": 200}, {"name": "f", "status": 400}, ...]
+    
+    (as for make_new_asset, 400 means invalid; 409 means the name was
+    already taken, either in the store or earlier in the same batch).
+    
+    Names can't start with an underscore (see NAME_PATTERN), so this route
+    can't shadow an asset named _bulk.
+    '''
+    data = request.get_json(force=True)
+    
+    if not isinstance(data, list):
+        abort(400)
+    
+    names = bulk_names(data)
+    taken = existing_names(set(names) - {None})
+    results, assets = triage_bulk(names, data, taken)
+    
+    by_name = {asset.name: asset for asset in assets}
+    sessions = []
+    for session, shard_names in group_by_shard(by_name):
+        session.add_all(by_name[name] for name in shard_names)
+        sessions.append(session)
+    
+    # If we're sharded, the batch is a transaction per shard. Flushing every
+    # shard before committing any of them means a conflict (or anything
+    # else the flush catches) rolls back the whole batch. The commits are
+    # still one after another, though, so this is best-effort: if a later
+    # commit fails, the earlier shards stay committed.
+    try:
+        for session in sessions:
+            session.flush()
+        for session in sessions:
+            session.commit()
+    
+    # Someone else created one of these names after we checked. Since the
+    # whole batch is one transaction, the whole batch is a conflict.
+    except IntegrityError:
+        for session in sessions:
+            session.rollback()
+        abort(409)
+    
+    # As for make_new_asset
+    except Exception:
+        for session in sessions:
+            session.rollback()
+        raise
+    
+    return jsonify(results)
+
+
 @app.route('/assets/v1/', methods=['GET'])
+@versioned
 def show_all_assets():
-    ''' Get all existing assets.
-    This is terribly, terribly inefficient for large databases of
-    assets; it should really, really be paginated for that.
+    ''' Get all existing assets. Pass limit (and then the returned
+    X-Next-Cursor as cursor) to page through them, type, class and/or
+    name_prefix to filter them (see compile_filters), and fields to pick
+    which fields to get (see parse_fields).
     '''
-    q = Asset.query.order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets()
+
+
+@app.route('/assets/v1/_stats', methods=['GET'])
+@versioned
+def show_asset_stats():
+    ''' Get the number of assets of each type and class, plus the total,
+    like this:
+    
+    {"classes": {"dish": 2, "dove": 5, ...}, "total": 12,
+     "types": {"antenna": 4, "satellite": 8}}
+    
+    These come from the (small) counts table, so this is cheap no matter
+    how many assets there are.
+    '''
+    q = db.session.query(AssetCount.asset_type, AssetCount.asset_class,
+                         AssetCount.count)
+    rows = itertools.chain.from_iterable(scatter(q))
+    return jsonify(summarize_counts(rows))
 
 
 @app.route('/assets/v1/<name>', methods=['GET'])
+@versioned
 def show_single_asset(name):
-    ''' Get a single existing asset, by name.
+    ''' Get a single existing asset, by name. Pass fields to only get
+    some of its fields (see parse_fields).
     '''
-    asset = Asset.query.get(name)
+    fields = parse_fields(request.args)
+    
+    # Only whole assets get cached
+    cache = app.extensions.get('plassets_asset_cache')
+    if fields is not None:
+        cache = None
+    
+    if cache is not None:
+        body = cache.get(name)
+        if body is not None:
+            return Response(body, mimetype='application/json')
+    
+    columns, serialize = projection(fields)
+    row = read_session(name).query(*columns).filter(
+        Asset._name == name).first()
     
-    if asset is None:
+    # Don't cache 404s; the asset might get created later
+    if row is None:
         abort(404)
-    else:
-        return jsonify(asset.dictify())
+    
+    body = (serialize(row) + '\n').encode('utf-8')
+    if cache is not None:
+        cache.put(name, body)
+    
+    return Response(body, mimetype='application/json')
     
     
 @app.route('/assets/v1/sat')
+@versioned
 def filter_sats():
     ''' Get all existing satellites.
     '''
-    q = Asset.query.filter_by(_asset_type='satellite').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_type='satellite')
     
     
 @app.route('/assets/v1/sat/dove')
+@versioned
 def filter_dove():
     ''' Get all existing Dove satellites.
     
     If we ever started to have name collisions in classes, this would
     need a smarter query.
     '''
-    q = Asset.query.filter_by(_asset_class='dove').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_class='dove')
     
     
 @app.route('/assets/v1/sat/rapideye')
+@versioned
 def filter_rapideye():
     ''' Get all existing RapidEye satellites.
     
     If we ever started to have name collisions in classes, this would
     need a smarter query.
     '''
-    q = Asset.query.filter_by(_asset_class='rapideye').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_class='rapideye')
     
     
 @app.route('/assets/v1/ant/')
+@versioned
 def filter_ants():
     ''' Get all existing antennae.
     '''
-    q = Asset.query.filter_by(_asset_type='antenna').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_type='antenna')
     
     
 @app.route('/assets/v1/ant/dish')
+@versioned
 def filter_dish():
     ''' Get all existing dish antennae.
     
     If we ever started to have name collisions in classes, this would
     need a smarter query.
     '''
-    q = Asset.query.filter_by(_asset_class='dish').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_class='dish')
     
     
 @app.route('/assets/v1/ant/yagi')
+@versioned
 def filter_yagi():
     ''' Get all existing yagi antennae.
     
     If we ever started to have name collisions in classes, this would
     need a smarter query.
     '''
-    q = Asset.query.filter_by(_asset_class='yagi').order_by(Asset.name)
-    return jsonify([asset.dictify() for asset in q.all()])
+    return list_assets(asset_class='yagi')
@@ -84,7 +84,8 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks',
+                                    'benchmarks.*']),
 
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
@@ -106,7 +107,11 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
-        'test': ['flask_testing']
+        'test': ['flask_testing'],
+        # For the asyncio server (python -m plassets --async); py3.5+ only
+        'async': ['aiosqlite', 'uvicorn'],
+        # For the pre-forking server (python -m plassets --workers N)
+        'workers': ['gunicorn']
     },
 
     # If there are data files included in your packages that need to be
@@ -34,11 +34,31 @@ Plassets: Planet Labs asset store coding exercise
 import unittest
 import flask_testing
 import tempfile
+import shutil
 import os
+import io
 import json
+import sqlite3
+import logging
+import logging.handlers
 import plassets
 
 from plassets import Asset
+from plassets.bulk import import_assets
+from plassets.bulk import export_assets
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+# The async app is optional (and py3 only)
+try:
+    import asyncio
+    from plassets.asgi import AsyncPlassets
+except (ImportError, SyntaxError):
+    AsyncPlassets = None
 
 
 # ###############################################
@@ -201,11 +221,100 @@ class AppTester(flask_testing.TestCase):
         self.assertEqual(200, res.status_code)
         self.assertIsNotNone(Asset.query.get(yagi1[1]['name']))
         
+        # Repeats are a conflict
+        res = self.client.post('/assets/v1/', data=json.dumps(yagi1[1]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(409, res.status_code)
+        
         # And, of course, check "authentication"
         res = self.client.post('/assets/v1/', data=json.dumps(yagi2[1]))
         self.assertEqual(401, res.status_code)
         self.assertIsNone(Asset.query.get(yagi2[1]['name']))
         
+        # Names that would be shadowed by other routes are invalid
+        res = self.client.post('/assets/v1/',
+                               data=json.dumps(dict(yagi2[1], name='_stats')),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(400, res.status_code)
+        res = self.client.post('/assets/v1/',
+                               data=json.dumps(dict(yagi2[1], name='abcd\n')),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(400, res.status_code)
+        res = self.client.get('/assets/v1/_stats')
+        self.assertEqual(res.json['total'], 7)
+    
+    def test_new_assets_bulk(self):
+        ''' Create a batch of assets at once, with some failures mixed in.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        plassets.db.session.add(dove1[0])
+        plassets.db.session.commit()
+        
+        batch = [dove1[1], dove2[1], dish1[1], dish1[1], {'name': 'yagi1'},
+                 dict(yagi2[1], details={'gain': 'foo'}), 'garbage',
+                 dict(rapideye1[1], name='_bulk')]
+        res = self.client.post('/assets/v1/_bulk', data=json.dumps(batch),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(res.json, [
+            {'name': 'dove1', 'status': 409},
+            {'name': 'dove2', 'status': 200},
+            {'name': 'dish1', 'status': 200},
+            {'name': 'dish1', 'status': 409},
+            {'name': 'yagi1', 'status': 400},
+            {'name': 'yagi2', 'status': 400},
+            {'name': None, 'status': 400},
+            {'name': '_bulk', 'status': 400},
+        ])
+        self.assertIsNotNone(Asset.query.get('dove2'))
+        self.assertIsNotNone(Asset.query.get('dish1'))
+        self.assertIsNone(Asset.query.get('yagi1'))
+        self.assertIsNone(Asset.query.get('yagi2'))
+        
+        # Not a list at all
+        res = self.client.post('/assets/v1/_bulk', data=json.dumps(yagi1[1]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(400, res.status_code)
+        
+        res = self.client.post('/assets/v1/_bulk', data=json.dumps([yagi1[1]]))
+        self.assertEqual(401, res.status_code)
+        self.assertIsNone(Asset.query.get('yagi1'))
+    
+    def test_failed_write(self):
+        ''' A write that fails unexpectedly shouldn't break the requests
+        after it (on the same thread, which share the session).
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        def fail_inserts(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO assets'):
+                raise RuntimeError('Disk full, probably')
+        
+        engine = plassets.db.get_engine()
+        event.listen(engine, 'before_cursor_execute', fail_inserts)
+        try:
+            with self.assertRaises(RuntimeError):
+                self.client.post('/assets/v1/', data=json.dumps(dove1[1]),
+                                 headers={'X-User': 'admin'})
+            with self.assertRaises(RuntimeError):
+                self.client.post('/assets/v1/_bulk',
+                                 data=json.dumps([dove2[1]]),
+                                 headers={'X-User': 'admin'})
+        
+        finally:
+            event.remove(engine, 'before_cursor_execute', fail_inserts)
+        
+        res = self.client.get('/assets/v1/')
+        self.assertEqual(res.json, [])
+        res = self.client.post('/assets/v1/', data=json.dumps(dove1[1]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(200, res.status_code)
+        res = self.client.post('/assets/v1/_bulk', data=json.dumps([dove2[1]]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(res.json, [{'name': 'dove2', 'status': 200}])
+    
     def test_get_single(self):
         ''' Test retrieving a single asset.
         '''
@@ -365,7 +474,930 @@ class AppTester(flask_testing.TestCase):
         res = self.client.get('/assets/v1/ant/yagi')
         self.assertEqual(res.json,
                          [yagi1[1], yagi2[1]])
+    
+    def test_filter_generic(self):
+        ''' Test filtering with query args.
+        '''
+        vecs = make_vectors()
+        for asset, __ in vecs:
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        res = self.client.get('/assets/v1/?type=satellite')
+        self.assertEqual(res.json,
+                         [dove1[1], dove2[1], rapideye1[1], rapideye2[1]])
+        
+        res = self.client.get('/assets/v1/?class=yagi&class=dove')
+        self.assertEqual(res.json, [dove1[1], dove2[1], yagi1[1], yagi2[1]])
+        res = self.client.get('/assets/v1/?class=yagi,dove')
+        self.assertEqual(res.json, [dove1[1], dove2[1], yagi1[1], yagi2[1]])
+        
+        res = self.client.get('/assets/v1/?name_prefix=d')
+        self.assertEqual(res.json, [dish1[1], dish2[1], dove1[1], dove2[1]])
+        res = self.client.get('/assets/v1/?name_prefix=dove')
+        self.assertEqual(res.json, [dove1[1], dove2[1]])
+        res = self.client.get('/assets/v1/?name_prefix=dove2')
+        self.assertEqual(res.json, [dove2[1]])
+        # Nothing can start with these (and U+10FFFF has no successor)
+        res = self.client.get('/assets/v1/?name_prefix=%F4%8F%BF%BF')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?name_prefix=dove!')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?name_prefix=dove%0A')
+        self.assertEqual(res.status_code, 400)
+        
+        # Everything combines with everything
+        res = self.client.get('/assets/v1/?type=antenna&name_prefix=d')
+        self.assertEqual(res.json, [dish1[1], dish2[1]])
+        res = self.client.get('/assets/v1/?type=antenna&class=dove')
+        self.assertEqual(res.json, [])
+        res = self.client.get('/assets/v1/sat?class=dove,dish')
+        self.assertEqual(res.json, [dove1[1], dove2[1]])
+        res = self.client.get('/assets/v1/?class=dove,yagi&limit=3')
+        self.assertEqual(res.json, [dove1[1], dove2[1], yagi1[1]])
+        
+        res = self.client.get('/assets/v1/?type=foo')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?class=dove,foo')
+        self.assertEqual(res.status_code, 400)
+        
+    def test_filter_details(self):
+        ''' Test filtering by detail values.
+        '''
+        assets = [
+            Asset('dish1', 'antenna', 'dish', diameter=8., radome=True),
+            Asset('dish2', 'antenna', 'dish', diameter=9.5, radome=False),
+            Asset('dish3', 'antenna', 'dish', diameter=12., radome=True),
+            Asset('dish4', 'antenna', 'dish'),
+            Asset('yagi1', 'antenna', 'yagi', gain=9.),
+            Asset('yagi2', 'antenna', 'yagi', gain=12.5),
+            Asset('yagi3', 'antenna', 'yagi', gain=15.),
+            Asset('dove1', 'satellite', 'dove'),
+        ]
+        for asset in assets:
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        
+        def names(url):
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            return [asset['name'] for asset in res.json]
+        
+        self.assertEqual(names('/assets/v1/?diameter__gt=9.0'),
+                         ['dish2', 'dish3'])
+        self.assertEqual(names('/assets/v1/?radome=true'), ['dish1', 'dish3'])
+        self.assertEqual(names('/assets/v1/?radome=false'), ['dish2'])
+        self.assertEqual(names('/assets/v1/?gain__gte=10&gain__lte=15'),
+                         ['yagi2', 'yagi3'])
+        self.assertEqual(names('/assets/v1/?gain__ne=12.5'),
+                         ['yagi1', 'yagi3'])
+        self.assertEqual(names('/assets/v1/?diameter__lt=10&radome=true'),
+                         ['dish1'])
+        self.assertEqual(names('/assets/v1/ant/dish?diameter=12'), ['dish3'])
+        # Details are class-specific
+        self.assertEqual(names('/assets/v1/sat?diameter__gt=1'), [])
+        self.assertEqual(names('/assets/v1/?class=yagi&radome=true'), [])
+        
+        res = self.client.get('/assets/v1/?diameter__gt=big')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?radome=maybe')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?diameter__about=9')
+        self.assertEqual(res.status_code, 400)
+        
+        # And make sure they're actually using the indexes
+        plans = (self.query_plans('/assets/v1/?diameter__gt=9.0') +
+                 self.query_plans('/assets/v1/?gain__gte=10&gain__lte=15') +
+                 self.query_plans('/assets/v1/?radome=true'))
+        self.assertIn('USING INDEX ix_assets_dish_diameter', plans[0])
+        self.assertIn('USING INDEX ix_assets_yagi_gain', plans[1])
+        self.assertIn('USING INDEX ix_assets_dish_radome', plans[2])
+        # Equality matches come out of the index already sorted by name
+        self.assertNotIn('TEMP B-TREE', plans[2])
+    
+    def test_details(self):
+        ''' Test that details make it through every kind of response.
+        '''
+        dish = Asset('bigdish', 'antenna', 'dish', radome=True, diameter=9.5)
+        yagi = Asset('someyagi', 'antenna', 'yagi', gain=12.)
+        plassets.db.session.add(dish)
+        plassets.db.session.add(yagi)
+        plassets.db.session.commit()
+        
+        # Stored as compact, key-sorted json
+        self.assertEqual(dish._details, '{"diameter":9.5,"radome":true}')
+        
+        dish_json = {
+            u'name': u'bigdish',
+            u'type': u'antenna',
+            u'class': u'dish',
+            u'details': {u'diameter': 9.5, u'radome': True}
+        }
+        yagi_json = {
+            u'name': u'someyagi',
+            u'type': u'antenna',
+            u'class': u'yagi',
+            u'details': {u'gain': 12.}
+        }
+        
+        res = self.client.get('/assets/v1/bigdish')
+        self.assertEqual(res.json, dish_json)
+        self.assertEqual(res.json, dish.dictify())
+        res = self.client.get('/assets/v1/')
+        self.assertEqual(res.json, [dish_json, yagi_json])
+        res = self.client.get('/assets/v1/ant/?stream=1')
+        self.assertEqual(res.json, [dish_json, yagi_json])
+    
+    def test_non_finite_details(self):
+        ''' NaN and infinite details aren't json, so they're invalid.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        with self.assertRaises(ValueError):
+            Asset('nandish', 'antenna', 'dish', diameter=float('nan'))
+        with self.assertRaises(ValueError):
+            plassets.validate_asset('infyagi', 'antenna', 'yagi',
+                                    {'gain': float('inf')})
+        
+        # NaN isn't even json, but python (and therefore flask) parses it
+        res = self.client.post(
+            '/assets/v1/', data='{"name": "dish1", "type": "antenna", '
+            '"class": "dish", "details": {"diameter": NaN}}',
+            headers={'X-User': 'admin'})
+        self.assertEqual(400, res.status_code)
+        
+        batch = [dove1[1], dict(yagi1[1], details={'gain': 1e400}),
+                 dict(dish1[1], details={'diameter': -1e400})]
+        res = self.client.post('/assets/v1/_bulk', data=json.dumps(batch),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([result['status'] for result in res.json],
+                         [200, 400, 400])
+        self.assertEqual(self.client.get('/assets/v1/').json, [dove1[1]])
+        
+    def test_asset_cache(self):
+        ''' Test the (opt-in) single asset response cache.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        plassets.db.session.add(dove1[0])
+        plassets.db.session.add(dove2[0])
+        plassets.db.session.add(dish1[0])
+        plassets.db.session.commit()
+        
+        plassets.app.config['PLASSETS_ASSET_CACHE'] = True
+        plassets.app.config['PLASSETS_ASSET_CACHE_MAX_ENTRIES'] = 2
+        try:
+            cache = plassets.init_asset_cache(plassets.app)
+            
+            res = self.client.get('/assets/v1/dove1')
+            self.assertEqual(res.json, dove1[1])
+            res = self.client.get('/assets/v1/dove1')
+            self.assertEqual(res.json, dove1[1])
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            
+            # 404s aren't cached
+            res = self.client.get('/assets/v1/yagi1')
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(len(cache), 1)
+            
+            # Least recently used gets evicted
+            self.client.get('/assets/v1/dove2')
+            self.client.get('/assets/v1/dove1')
+            res = self.client.get('/assets/v1/dish1')
+            self.assertEqual(res.json, dish1[1])
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get('dove2'))
+            self.assertIsNotNone(cache.get('dove1'))
+            
+        finally:
+            del plassets.app.config['PLASSETS_ASSET_CACHE']
+            del plassets.app.config['PLASSETS_ASSET_CACHE_MAX_ENTRIES']
+            plassets.init_asset_cache(plassets.app)
+    
+    def test_metrics(self):
+        ''' Test the (opt-in) Prometheus metrics.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 404)
+        
+        plassets.app.config['PLASSETS_METRICS'] = True
+        plassets.app.config['PLASSETS_ASSET_CACHE'] = True
+        try:
+            plassets.init_metrics(plassets.app)
+            plassets.init_asset_cache(plassets.app)
+            
+            self.client.post('/assets/v1/', data=json.dumps(dove1[1]),
+                             headers={'X-User': 'admin'})
+            self.client.get('/assets/v1/dove1')
+            self.client.get('/assets/v1/dove1')
+            self.client.get('/assets/v1/nope')
+            self.client.get('/assets/v1/?stream=1')
+            
+            res = self.client.get('/metrics')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.mimetype, 'text/plain')
+            samples = {}
+            for line in res.get_data(as_text=True).splitlines():
+                if not line.startswith('#'):
+                    name, value = line.rsplit(' ', 1)
+                    samples[name] = float(value)
+        
+        finally:
+            del plassets.app.config['PLASSETS_METRICS']
+            del plassets.app.config['PLASSETS_ASSET_CACHE']
+            plassets.init_metrics(plassets.app)
+            plassets.init_asset_cache(plassets.app)
+        
+        single = 'endpoint="show_single_asset"'
+        self.assertEqual(samples['plassets_requests_total{' + single +
+                                 ',method="GET",status="200"}'], 2)
+        self.assertEqual(samples['plassets_requests_total{' + single +
+                                 ',method="GET",status="404"}'], 1)
+        self.assertEqual(samples['plassets_requests_total{endpoint="'
+                                 'make_new_asset",method="POST",'
+                                 'status="200"}'], 1)
+        self.assertEqual(samples['plassets_request_duration_seconds_count{' +
+                                 single + '}'], 3)
+        self.assertEqual(samples['plassets_request_duration_seconds_bucket{' +
+                                 single + ',le="+Inf"}'], 3)
+        # Streamed responses have no size
+        self.assertEqual(samples['plassets_response_size_bytes_count{' +
+                                 single + '}'], 3)
+        self.assertNotIn('plassets_response_size_bytes_count{endpoint="'
+                         'show_all_assets"}', samples)
+        self.assertGreater(samples['plassets_db_pool_checkouts_total'], 0)
+        self.assertEqual(samples['plassets_asset_cache_hits_total'], 1)
+        self.assertEqual(samples['plassets_asset_cache_hit_ratio'], 1 / 3.)
+    
+    def test_query_accounting(self):
+        ''' Test the per-request query counts, and the slow query log.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        # Only in debug mode
+        res = self.client.get('/assets/v1/dove1')
+        self.assertNotIn('X-Query-Count', res.headers)
+        
+        plassets.app.config['DEBUG'] = True
+        try:
+            res = self.client.post('/assets/v1/', data=json.dumps(dove1[1]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.status_code, 200)
+            # The insert and the count update, plus (at least) the transaction
+            self.assertGreaterEqual(int(res.headers['X-Query-Count']), 2)
+            
+            res = self.client.get('/assets/v1/dove1')
+            self.assertEqual(res.headers['X-Query-Count'], '1')
+            self.assertGreaterEqual(float(res.headers['X-DB-Time']), 0)
+            
+            # Failed statements don't throw off later ones (on the same
+            # connection, or otherwise)
+            res = self.client.post('/assets/v1/', data=json.dumps(dove1[1]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.status_code, 409)
+            res = self.client.get('/assets/v1/dove1')
+            self.assertEqual(res.headers['X-Query-Count'], '1')
+            self.assertGreaterEqual(float(res.headers['X-DB-Time']), 0)
+            self.assertLess(float(res.headers['X-DB-Time']), 1)
+            
+            with plassets.db.engine.connect() as conn:
+                info = dict(conn.info)
+                with self.assertRaises(IntegrityError):
+                    conn.execute(Asset.__table__.insert(),
+                                 name='dove1', type='satellite',
+                                 **{'class': 'dove', 'details': '{}'})
+                conn.execute('SELECT 1')
+                self.assertEqual(dict(conn.info), info)
+            
+            # Everything is slow, with a threshold of 0. (Not assertLogs,
+            # which is python 3 only.)
+            plassets.app.config['PLASSETS_SLOW_QUERY_SECONDS'] = 0
+            sql_logger = logging.getLogger('plassets.sql')
+            handler = logging.handlers.BufferingHandler(100)
+            sql_logger.addHandler(handler)
+            try:
+                self.client.get('/assets/v1/dove1')
+            finally:
+                sql_logger.removeHandler(handler)
+            
+            logs = [record.getMessage() for record in handler.buffer
+                    if record.levelno >= logging.WARNING]
+            self.assertEqual(len(logs), 1)
+            self.assertIn('GET /assets/v1/dove1', logs[0])
+            self.assertIn('FROM asset', logs[0])
+            self.assertIn("'dove1'", logs[0])
+        
+        finally:
+            plassets.app.config['DEBUG'] = False
+            plassets.app.config.pop('PLASSETS_SLOW_QUERY_SECONDS', None)
+    
+    def test_etag(self):
+        ''' Test ETags and conditional GETs.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        plassets.db.session.add(dove1[0])
+        plassets.db.session.commit()
+        
+        res = self.client.get('/assets/v1/')
+        etag = res.headers['ETag']
+        res = self.client.get('/assets/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_data(), b'')
+        
+        # Filters and single assets, too
+        res = self.client.get('/assets/v1/sat/dove',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get('/assets/v1/dove1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        
+        # ndjson gets a separate etag
+        res = self.client.get('/assets/v1/', headers={
+            'If-None-Match': etag, 'Accept': 'application/x-ndjson'})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        
+        # Any write changes the etag, whether through the api...
+        res = self.client.post('/assets/v1/', data=json.dumps(dove2[1]),
+                               headers={'X-User': 'admin'})
+        res = self.client.get('/assets/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, [dove1[1], dove2[1]])
+        self.assertNotEqual(res.headers['ETag'], etag)
+        etag = res.headers['ETag']
+        
+        # ... or not
+        plassets.db.session.add(dish1[0])
+        plassets.db.session.commit()
+        res = self.client.get('/assets/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json, [dish1[1], dove1[1], dove2[1]])
+        
+        # But failed writes don't
+        etag = res.headers['ETag']
+        res = self.client.post('/assets/v1/', data=json.dumps(dove2[1]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(res.status_code, 409)
+        res = self.client.get('/assets/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+    
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_shared_version(self):
+        ''' Test that writes in a forked worker change the etag in the
+        parent, with PLASSETS_SHARED_VERSION.
+        '''
+        plassets.app.config['PLASSETS_SHARED_VERSION'] = True
+        try:
+            version = plassets.plassets.init_store_version(plassets.app)
+        finally:
+            del plassets.app.config['PLASSETS_SHARED_VERSION']
+        
+        self.assertIsInstance(version, plassets.plassets.SharedStoreVersion)
+        etag = self.client.get('/assets/v1/').headers['ETag']
+        
+        pid = os.fork()
+        if pid == 0:
+            version.bump()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        
+        self.assertEqual(version.value, 1)
+        res = self.client.get('/assets/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+    
+    def query_plans(self, url):
+        ''' GET the url, and return the query plans for every SELECT it
+        issued (each as a single string).
+        '''
+        engine = plassets.db.get_engine()
+        statements = []
+        
+        def capture(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+        
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        
+        plans = []
+        for statement, parameters in statements:
+            conn = engine.raw_connection()
+            try:
+                plan = conn.cursor().execute(
+                    'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            finally:
+                conn.close()
+            plans.append(' '.join(row[-1] for row in plan))
+        
+        return plans
+    
+    def test_query_plans(self):
+        ''' Make sure that none of the listings need to sort.
+        '''
+        for asset, __ in make_vectors():
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        
+        cursor = plassets.plassets.encode_cursor('dish1')
+        urls = ['/assets/v1/', '/assets/v1/sat', '/assets/v1/sat/dove',
+                '/assets/v1/sat/rapideye', '/assets/v1/ant/',
+                '/assets/v1/ant/dish', '/assets/v1/ant/yagi']
+        urls.extend(['/assets/v1/?type=satellite', '/assets/v1/?class=dish',
+                     '/assets/v1/?name_prefix=do',
+                     '/assets/v1/?class=dove&name_prefix=do'])
+        urls.extend([url + ('&' if '?' in url else '?') +
+                     'limit=2&cursor=' + cursor for url in urls])
+        
+        for url in urls:
+            plans = self.query_plans(url)
+            self.assertTrue(plans)
+            for plan in plans:
+                self.assertNotIn('TEMP B-TREE', plan, url)
+            
+    def test_upgrade_db(self):
+        ''' Test upgrading a database with the old single-column indexes.
+        '''
+        engine = plassets.db.get_engine()
+        engine.execute('DROP INDEX ix_assets_type_name')
+        engine.execute('DROP INDEX ix_assets_class_name')
+        engine.execute('DROP INDEX ix_assets_dish_diameter')
+        engine.execute('CREATE INDEX ix_assets_type ON assets (type)')
+        engine.execute('CREATE INDEX ix_assets_class ON assets (class)')
+        
+        plassets.upgrade_db()
+        # Running it twice is harmless
+        plassets.upgrade_db()
+        
+        indexes = {name for name, in engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn('ix_assets_type_name', indexes)
+        self.assertIn('ix_assets_class_name', indexes)
+        self.assertIn('ix_assets_dish_diameter', indexes)
+        self.assertNotIn('ix_assets_type', indexes)
+        self.assertNotIn('ix_assets_class', indexes)
+        
+    def test_paginate(self):
+        ''' Test paging through assets with limit and cursor.
+        '''
+        vecs = make_vectors()
+        for asset, __ in vecs:
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        res = self.client.get('/assets/v1/?limit=3')
+        self.assertEqual(res.json, [dish1[1], dish2[1], dove1[1]])
+        cursor = res.headers['X-Next-Cursor']
+        
+        res = self.client.get('/assets/v1/?limit=3&cursor=' + cursor)
+        self.assertEqual(res.json, [dove2[1], rapideye1[1], rapideye2[1]])
+        cursor = res.headers['X-Next-Cursor']
+        
+        res = self.client.get('/assets/v1/?limit=3&cursor=' + cursor)
+        self.assertEqual(res.json, [yagi1[1], yagi2[1]])
+        self.assertNotIn('X-Next-Cursor', res.headers)
+        
+        # Filters page too
+        res = self.client.get('/assets/v1/sat?limit=1')
+        self.assertEqual(res.json, [dove1[1]])
+        cursor = res.headers['X-Next-Cursor']
+        res = self.client.get('/assets/v1/sat?limit=10&cursor=' + cursor)
+        self.assertEqual(res.json, [dove2[1], rapideye1[1], rapideye2[1]])
+        
+        # And bad arguments are rejected
+        res = self.client.get('/assets/v1/?limit=0')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?limit=foo')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?cursor=!!!')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/?cursor=' + cursor + '%0A')
+        self.assertEqual(res.status_code, 400)
+
+    def test_stream(self):
+        ''' Test streaming listings, both as a json array and as ndjson.
+        '''
+        vecs = make_vectors()
+        for asset, __ in vecs:
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        expected = [dish1[1], dish2[1], dove1[1], dove2[1],
+                    rapideye1[1], rapideye2[1], yagi1[1], yagi2[1]]
+        
+        # Make sure the chunking boundaries get exercised
+        batch_size = plassets.plassets.STREAM_BATCH_SIZE
+        plassets.plassets.STREAM_BATCH_SIZE = 3
+        try:
+            res = self.client.get('/assets/v1/?stream=1')
+            self.assertEqual(res.json, expected)
+            
+            res = self.client.get('/assets/v1/',
+                                  headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual(res.mimetype, 'application/x-ndjson')
+            lines = res.get_data(as_text=True).splitlines()
+            self.assertEqual([json.loads(line) for line in lines], expected)
+            
+            res = self.client.get('/assets/v1/ant/dish?stream=1')
+            self.assertEqual(res.json, [dish1[1], dish2[1]])
+            res = self.client.get('/assets/v1/?stream=1&limit=5')
+            self.assertEqual(res.json, expected[:5])
+            res = self.client.get('/assets/v1/?stream=1&limit=6')
+            self.assertEqual(res.json, expected[:6])
+            
+            # Nothing is left open between batches, so a slow client doesn't
+            # hold a read lock, which (without a write-ahead log) would
+            # block writers
+            res = self.client.get('/assets/v1/?stream=1', buffered=False)
+            chunks = iter(res.response)
+            body = next(chunks) + next(chunks)
+            conn = sqlite3.connect(self.db_path, timeout=0)
+            try:
+                conn.execute('BEGIN EXCLUSIVE')
+                conn.rollback()
+            finally:
+                conn.close()
+            body += b''.join(chunks)
+            res.close()
+            self.assertEqual(json.loads(body.decode('utf-8')), expected)
+        
+        finally:
+            plassets.plassets.STREAM_BATCH_SIZE = batch_size
         
+        # Empty results are still valid json
+        res = self.client.get('/assets/v1/?stream=1&cursor=' +
+                              plassets.plassets.encode_cursor('zzzz'))
+        self.assertEqual(res.json, [])
+
+    def test_fields(self):
+        ''' Test sparse fieldsets, and that they skip the details column.
+        '''
+        vecs = make_vectors()
+        for asset, __ in vecs:
+            plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        def pick(expected, *fields):
+            return {field: expected[1][field] for field in fields}
+        
+        engine = plassets.db.get_engine()
+        statements = []
+        
+        def capture(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+        
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res = self.client.get('/assets/v1/?fields=name')
+            self.assertEqual(res.json, [pick(dish1, 'name'),
+                                        pick(dish2, 'name'),
+                                        pick(dove1, 'name'),
+                                        pick(dove2, 'name'),
+                                        pick(rapideye1, 'name'),
+                                        pick(rapideye2, 'name'),
+                                        pick(yagi1, 'name'),
+                                        pick(yagi2, 'name')])
+            
+            res = self.client.get('/assets/v1/ant/dish?fields=class,type')
+            self.assertEqual(res.json, [pick(dish1, 'class', 'type'),
+                                        pick(dish2, 'class', 'type')])
+            
+            res = self.client.get('/assets/v1/?fields=class&fields=name&'
+                                  'limit=1&stream=1')
+            self.assertEqual(res.json, [pick(dish1, 'class', 'name')])
+            
+            res = self.client.get('/assets/v1/dove1?fields=type')
+            self.assertEqual(res.json, pick(dove1, 'type'))
+        
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        
+        self.assertTrue(statements)
+        for statement in statements:
+            self.assertNotIn('details', statement)
+        
+        res = self.client.get('/assets/v1/dish1?fields=details,name')
+        self.assertEqual(res.json, pick(dish1, 'details', 'name'))
+        # Partial responses don't pollute the cache
+        res = self.client.get('/assets/v1/dish1')
+        self.assertEqual(res.json, dish1[1])
+        
+        res = self.client.get('/assets/v1/?fields=name,foo')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/assets/v1/dish1?fields=_details')
+        self.assertEqual(res.status_code, 400)
+
+    def test_stats(self):
+        ''' Test the asset counts, including that failed writes don't
+        count, and that upgrade_db rebuilds them.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        res = self.client.get('/assets/v1/_stats')
+        self.assertEqual(res.json['total'], 0)
+        self.assertEqual(res.json['types'], {'antenna': 0, 'satellite': 0})
+        
+        for vec in (dove1, dove2, dish1):
+            res = self.client.post('/assets/v1/', data=json.dumps(vec[1]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.status_code, 200)
+        res = self.client.post('/assets/v1/_bulk',
+                               data=json.dumps([rapideye1[1], yagi1[1],
+                                                dove1[1]]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(res.status_code, 200)
+        # Conflicts don't count
+        res = self.client.post('/assets/v1/', data=json.dumps(dish1[1]),
+                               headers={'X-User': 'admin'})
+        self.assertEqual(res.status_code, 409)
+        
+        expected = {
+            'classes': {'dish': 1, 'dove': 2, 'rapideye': 1, 'yagi': 1},
+            'total': 5,
+            'types': {'antenna': 2, 'satellite': 3}
+        }
+        res = self.client.get('/assets/v1/_stats')
+        self.assertEqual(res.json, expected)
+        
+        plassets.db.get_engine().execute('DELETE FROM asset_counts')
+        plassets.upgrade_db()
+        res = self.client.get('/assets/v1/_stats')
+        self.assertEqual(res.json, expected)
+
+    def test_shards(self):
+        ''' Test a sharded store: everything should work exactly the same
+        as unsharded.
+        '''
+        vecs = make_vectors()
+        tempdir = tempfile.mkdtemp()
+        engines = []
+        plassets.app.config['PLASSETS_SHARDS'] = 3
+        plassets.app.config['SQLALCHEMY_BINDS'] = {
+            plassets.plassets.shard_bind(index):
+                'sqlite:///' + os.path.join(tempdir, 'shard%d.db' % index)
+            for index in (1, 2)
+        }
+        try:
+            plassets.init_shards(plassets.app)
+            plassets.upgrade_db()
+            
+            res = self.client.post('/assets/v1/_bulk',
+                                   data=json.dumps([vec[1] for vec in vecs]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(set(result['status'] for result in res.json),
+                             {200})
+            # They really are spread out
+            engines = plassets.plassets.shard_engines(plassets.app)
+            per_shard = [engine.execute('SELECT count(*) FROM assets').scalar()
+                         for engine in engines]
+            self.assertEqual(sum(per_shard), 8)
+            self.assertGreater(min(per_shard), 0)
+            
+            res = self.client.post('/assets/v1/', data=json.dumps(vecs[0][1]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.status_code, 409)
+            res = self.client.post('/assets/v1/_bulk',
+                                   data=json.dumps([vecs[1][1]]),
+                                   headers={'X-User': 'admin'})
+            self.assertEqual(res.json, [{'name': 'dove2', 'status': 409}])
+            
+            for asset, data in vecs:
+                res = self.client.get('/assets/v1/' + asset.name)
+                self.assertEqual(res.json, data)
+            
+            # Listings are merged back into name order
+            expected = sorted((vec[1] for vec in vecs),
+                              key=lambda data: data['name'])
+            res = self.client.get('/assets/v1/')
+            self.assertEqual(res.json, expected)
+            res = self.client.get('/assets/v1/?stream=1')
+            self.assertEqual(res.json, expected)
+            res = self.client.get('/assets/v1/?stream=1&limit=3')
+            self.assertEqual(res.json, expected[:3])
+            res = self.client.get('/assets/v1/ant/')
+            self.assertEqual(res.json, [data for data in expected
+                                        if data['type'] == 'antenna'])
+            
+            # And so is pagination
+            pages = []
+            res = self.client.get('/assets/v1/?limit=3')
+            pages.extend(res.json)
+            while 'X-Next-Cursor' in res.headers:
+                res = self.client.get('/assets/v1/?limit=3&cursor=' +
+                                      res.headers['X-Next-Cursor'])
+                pages.extend(res.json)
+            self.assertEqual(pages, expected)
+            
+            res = self.client.get('/assets/v1/_stats')
+            self.assertEqual(res.json['total'], 8)
+            self.assertEqual(res.json['types'],
+                             {'antenna': 4, 'satellite': 4})
+        
+        finally:
+            del plassets.app.config['PLASSETS_SHARDS']
+            del plassets.app.config['SQLALCHEMY_BINDS']
+            plassets.init_shards(plassets.app)
+            for engine in engines[1:]:
+                engine.dispose()
+            shutil.rmtree(tempdir)
+    
+    def test_readers(self):
+        ''' Test reading through separate, read-only engines: reads should
+        see every write, without ever touching the writer.
+        '''
+        vecs = make_vectors()
+        statements = []
+        
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        
+        plassets.app.config['PLASSETS_READER_DATABASE_URI'] = \
+            'sqlite:///file:' + self.db_path + '?mode=ro&uri=true'
+        plassets.app.config['PLASSETS_READER_ENGINE_OPTIONS'] = {
+            'poolclass': QueuePool,
+            'pool_size': 3
+        }
+        plassets.app.config['PLASSETS_METRICS'] = True
+        try:
+            plassets.init_metrics(plassets.app)
+            readers = plassets.init_readers(plassets.app)
+            reader = readers.engines[0]
+            event.listen(reader, 'before_cursor_execute', count_statement)
+            
+            for asset, data in vecs:
+                res = self.client.post('/assets/v1/', data=json.dumps(data),
+                                       headers={'X-User': 'admin'})
+                self.assertEqual(res.status_code, 200)
+            self.assertEqual(statements, [])
+            
+            for asset, data in vecs:
+                res = self.client.get('/assets/v1/' + asset.name)
+                self.assertEqual(res.json, data)
+            expected = sorted((vec[1] for vec in vecs),
+                              key=lambda data: data['name'])
+            res = self.client.get('/assets/v1/')
+            self.assertEqual(res.json, expected)
+            res = self.client.get('/assets/v1/?stream=1&limit=3')
+            self.assertEqual(res.json, expected[:3])
+            res = self.client.get('/assets/v1/_stats')
+            self.assertEqual(res.json['total'], 8)
+            self.assertEqual(len(statements), 11)
+            
+            # The reader really is read-only
+            self.assertRaises(
+                OperationalError, reader.execute,
+                'DELETE FROM assets'
+            )
+            
+            # Its pool has its own gauges (the writer's isn't a QueuePool)
+            res = self.client.get('/metrics')
+            lines = res.get_data(as_text=True).splitlines()
+            self.assertIn('plassets_db_pool_size{role="reader",shard="0"} 3',
+                          lines)
+            self.assertTrue(any(
+                line.startswith('plassets_db_pool_checked_out{role="reader",'
+                                'shard="0"} ') for line in lines))
+            self.assertFalse(any('role="writer"' in line for line in lines))
+        
+        finally:
+            del plassets.app.config['PLASSETS_READER_DATABASE_URI']
+            del plassets.app.config['PLASSETS_READER_ENGINE_OPTIONS']
+            del plassets.app.config['PLASSETS_METRICS']
+            plassets.init_readers(plassets.app)
+            plassets.init_metrics(plassets.app)
+    
+    @unittest.skipUnless(hasattr(sqlite3.Connection, 'backup'),
+                         'needs python 3.7+')
+    def test_snapshot(self):
+        ''' Test snapshotting the database (while it's in use), and
+        restoring from the snapshots.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        plassets.db.session.add(dove1[0])
+        plassets.db.session.commit()
+        
+        tempdir = tempfile.mkdtemp()
+        try:
+            snapshot = os.path.join(tempdir, 'snapshot.db')
+            # A write that's in progress isn't included
+            plassets.db.session.add(dove2[0])
+            plassets.db.session.flush()
+            plassets.snapshot_db(snapshot)
+            plassets.db.session.commit()
+            self.assertFalse(os.path.exists(snapshot + '.partial'))
+            
+            restored = os.path.join(tempdir, 'restored.db')
+            plassets.restore_snapshot(snapshot, restored)
+            conn = sqlite3.connect(restored)
+            try:
+                self.assertEqual(
+                    conn.execute('SELECT name FROM assets').fetchall(),
+                    [('dove1',)])
+                self.assertEqual(
+                    conn.execute('SELECT count FROM asset_counts').fetchall(),
+                    [(1,)])
+            finally:
+                conn.close()
+            
+            # Later snapshots replace earlier ones
+            plassets.snapshot_db(snapshot)
+            plassets.restore_snapshot(snapshot, restored)
+            conn = sqlite3.connect(restored)
+            try:
+                self.assertEqual(
+                    conn.execute('SELECT name FROM assets').fetchall(),
+                    [('dove1',), ('dove2',)])
+            finally:
+                conn.close()
+            
+            # Missing snapshots (or shards of them) aren't silently empty
+            missing = os.path.join(tempdir, 'missing.db')
+            with self.assertRaises(IOError):
+                plassets.restore_snapshot(missing, restored)
+            with self.assertRaises(IOError):
+                plassets.restore_snapshot(snapshot, restored, shards=2)
+            self.assertFalse(os.path.exists(missing))
+            conn = sqlite3.connect(restored)
+            try:
+                self.assertEqual(
+                    conn.execute('SELECT count(*) FROM assets').fetchone(),
+                    (2,))
+            finally:
+                conn.close()
+        
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def test_import_export(self):
+        ''' Test bulk imports (with and without a process pool) and
+        exports, in both formats.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        dish1[1]['details'] = {'diameter': 2.5, 'radome': True}
+        plassets.db.session.add(dove1[0])
+        plassets.db.session.commit()
+        
+        lines = [json.dumps(vec[1]) for vec in (dish1, dove1, yagi1)]
+        # Invalid (and unparseable) ones, plus a repeat from the same file
+        lines[2:2] = ['{"name": "f", "type": "satellite", "class": "dove"}',
+                      '', 'nope', json.dumps(dish1[1])]
+        stream = io.StringIO(u'\n'.join(lines) + u'\n')
+        etag = self.client.get('/assets/v1/').headers['ETag']
+        stats = import_assets(stream, processes=1)
+        self.assertEqual(stats, {'imported': 2, 'conflicts': 2,
+                                 'invalid': [3, 5]})
+        # Counts and etags are kept up to date
+        res = self.client.get('/assets/v1/_stats')
+        self.assertEqual(res.json['classes'],
+                         {'dish': 1, 'dove': 1, 'rapideye': 0, 'yagi': 1})
+        self.assertNotEqual(self.client.get('/assets/v1/').headers['ETag'],
+                            etag)
+        
+        # Same thing, as csv, across processes
+        stream = io.StringIO(
+            u'name,type,class,details\n'
+            u'dove2,satellite,dove,\n'
+            u'dish2,antenna,dish,"{""diameter"": 7.0}"\n'
+            u'yagi2,antenna,yagi,"{""diameter"": 7.0}"\n'
+            u'dish3,antenna,dish,"{""diameter"": 1e400}"\n'
+        )
+        stats = import_assets(stream, 'csv', processes=2, transaction_size=1)
+        self.assertEqual(stats, {'imported': 2, 'conflicts': 0,
+                                 'invalid': [4, 5]})
+        
+        stream = io.StringIO()
+        self.assertEqual(export_assets(stream), 5)
+        exported = [json.loads(line) for line in
+                    stream.getvalue().splitlines()]
+        self.assertEqual(exported, self.client.get('/assets/v1/').json)
+        self.assertEqual(exported[0], dish1[1])
+        
+        # Which can be imported straight back in
+        stream = io.StringIO()
+        export_assets(stream, 'csv')
+        stream.seek(0)
+        stats = import_assets(stream, 'csv', processes=1)
+        self.assertEqual(stats, {'imported': 0, 'conflicts': 5,
+                                 'invalid': []})
+
         
 class AssetTester(flask_testing.TestCase):
     ''' Ancillary testing for plassets assets to ensure they correctly
@@ -406,6 +1438,17 @@ class AssetTester(flask_testing.TestCase):
         with self.assertRaises(ValueError):
             Asset('foo!', 'satellite', 'dove')
         
+        # [A-z] would let these through
+        with self.assertRaises(ValueError):
+            Asset('_stats', 'satellite', 'dove')
+        
+        with self.assertRaises(ValueError):
+            Asset('foo[bar]', 'satellite', 'dove')
+        
+        # $ would let this through
+        with self.assertRaises(ValueError):
+            Asset('abcd\n', 'satellite', 'dove')
+        
         with self.assertRaises(ValueError):
             Asset('foofoofoofoofoofoofoofoofoofoofoofoofoofoofoofoofoofoo' +
                   'foofoofoofo', 'satellite', 'dove')
@@ -439,8 +1482,12 @@ class AssetTester(flask_testing.TestCase):
         with self.assertRaises(AttributeError):
             asset.name = 'name2'
         
-        with self.assertRaises(ValueError):
-            asset = Asset('name', 'satellite', 'dove')
+        # Uniqueness is enforced by the database, on flush
+        asset = Asset('name', 'satellite', 'dove')
+        plassets.db.session.add(asset)
+        with self.assertRaises(IntegrityError):
+            plassets.db.session.commit()
+        plassets.db.session.rollback()
             
     def test_retrieve(self):
         ''' Test that retrieving objects works correctly (makes sure
@@ -454,6 +1501,54 @@ class AssetTester(flask_testing.TestCase):
         self.assertEqual(asset.name, asset2.name)
         self.assertEqual(asset.asset_class, asset2.asset_class)
     
+    def test_detail_sync(self):
+        ''' Test that details are parsed once, and saved on flush.
+        '''
+        asset = Asset('name', 'antenna', 'dish', diameter=1.)
+        asset.radome = True
+        # Nothing's been dumped to json yet
+        self.assertIsNone(asset._details)
+        self.assertEqual(asset.dictify()['details'],
+                         {'diameter': 1., 'radome': True})
+        
+        plassets.db.session.add(asset)
+        plassets.db.session.commit()
+        self.assertEqual(asset._details, '{"diameter":1.0,"radome":true}')
+        
+        # Details aren't immutable in the internal model
+        asset.diameter = 2.
+        plassets.db.session.commit()
+        plassets.db.session.expunge_all()
+        
+        asset = Asset.query.get('name')
+        self.assertEqual(asset.diameter, 2.)
+        # Parsed once, then reused
+        decoded = asset.decoded_details
+        self.assertTrue(asset.radome)
+        self.assertIs(asset.decoded_details, decoded)
+        
+        # Changes that were never flushed are forgotten on refresh
+        asset.diameter = 3.
+        plassets.db.session.refresh(asset)
+        self.assertEqual(asset.diameter, 2.)
+    
+    def test_validate_asset(self):
+        ''' Test validating assets without creating them.
+        '''
+        plassets.validate_asset('name', 'antenna', 'dish', {'radome': True})
+        
+        with self.assertRaises(ValueError):
+            plassets.validate_asset('foo', 'antenna', 'dish', {})
+        with self.assertRaises(ValueError):
+            plassets.validate_asset('name', 'satellite', 'dish', {})
+        with self.assertRaises(ValueError):
+            plassets.validate_asset('name', ['antenna'], 'dish', {})
+        # Details for the wrong class
+        with self.assertRaises(AttributeError):
+            plassets.validate_asset('name', 'antenna', 'yagi', {'radome': True})
+        with self.assertRaises(TypeError):
+            plassets.validate_asset('name', 'antenna', 'dish', {'radome': 1})
+        
     def test_dove(self):
         ''' Test valid and invalid doves
         '''
@@ -501,5 +1596,245 @@ class AssetTester(flask_testing.TestCase):
             Asset('name', 'antenna', 'yagi', gain='foo')
 
 
+class SqliteTester(flask_testing.TestCase):
+    ''' Make sure the sqlite tuning pragmas actually get applied.
+    '''
+    
+    @classmethod
+    def setUpClass(cls):
+        # WAL mode leaves extra files next to the database
+        cls.db_dir = tempfile.mkdtemp()
+        cls.db_path = os.path.join(cls.db_dir, 'plassets.db')
+    
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.db_dir)
+    
+    def setUp(self):
+        self.client = plassets.app.test_client()
+        plassets.db.create_all()
+    
+    def tearDown(self):
+        plassets.db.session.remove()
+        plassets.db.drop_all()
+        plassets.db.get_engine().dispose()
+        del plassets.app.config['PLASSETS_SQLITE_PRAGMAS']
+    
+    def create_app(self):
+        return plassets.create_app(
+            TESTING = True,
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.db_path,
+            SQLALCHEMY_TRACK_MODIFICATIONS = False,
+            PLASSETS_SQLITE_PRAGMAS = dict(
+                plassets.SQLITE_PROFILES['balanced'],
+                cache_size = -1234
+            )
+        )
+    
+    def test_pragmas(self):
+        ''' Test that the profile was applied.
+        '''
+        conn = plassets.db.session.connection()
+        pragma = lambda name: conn.execute('PRAGMA ' + name).scalar()
+        self.assertEqual(pragma('journal_mode'), 'wal')
+        # 1 == normal
+        self.assertEqual(pragma('synchronous'), 1)
+        self.assertEqual(pragma('cache_size'), -1234)
+        self.assertEqual(pragma('busy_timeout'), 5000)
+        
+        # And that everything else still works with it
+        plassets.db.session.add(Asset('dove1', 'satellite', 'dove'))
+        plassets.db.session.commit()
+        res = self.client.get('/assets/v1/dove1')
+        self.assertEqual(res.status_code, 200)
+
+
+
+@unittest.skipIf(AsyncPlassets is None, 'async extra not installed')
+class AsyncTester(unittest.TestCase):
+    ''' Make sure the ASGI app behaves the same as the flask one.
+    '''
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.db_dir = tempfile.mkdtemp()
+        cls.db_path = os.path.join(cls.db_dir, 'plassets.db')
+        cls.engine = sqlalchemy.create_engine('sqlite:///' + cls.db_path)
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+        shutil.rmtree(cls.db_dir)
+    
+    def setUp(self):
+        plassets.db.Model.metadata.create_all(self.engine)
+        self.loop = asyncio.new_event_loop()
+        self.app = AsyncPlassets(self.db_path, pool_size=2)
+    
+    def tearDown(self):
+        self.loop.run_until_complete(self.app.close())
+        self.loop.close()
+        plassets.db.Model.metadata.drop_all(self.engine)
+    
+    def done(self, result=None):
+        # Awaitable, without needing async def (and therefore py3) here
+        future = self.loop.create_future()
+        future.set_result(result)
+        return future
+    
+    def request(self, method, path, query='', headers=None, data=None):
+        ''' Make a request to the app. Returns the status, headers and
+        body of the response.
+        '''
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        headers = headers or {}
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query.encode('ascii'),
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                        for key, value in headers.items()]
+        }
+        messages = []
+        
+        def receive():
+            return self.done({'type': 'http.request', 'body': body})
+        
+        def send(message):
+            messages.append(message)
+            return self.done()
+        
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        start = messages[0]
+        headers = {key.decode('latin-1'): value.decode('latin-1')
+                   for key, value in start['headers']}
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return start['status'], headers, body
+    
+    def get_json(self, path, query=''):
+        status, headers, body = self.request('GET', path, query)
+        self.assertEqual(status, 200)
+        return json.loads(body.decode('utf-8'))
+    
+    def test_create(self):
+        ''' Test creating assets, singly and in bulk, and the stats.
+        '''
+        vecs = make_vectors()
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        admin = {'X-User': 'admin'}
+        
+        status, __, __ = self.request('POST', '/assets/v1/', headers=admin,
+                                      data=dove1[1])
+        self.assertEqual(status, 200)
+        status, __, __ = self.request('POST', '/assets/v1/', headers=admin,
+                                      data=dove1[1])
+        self.assertEqual(status, 409)
+        status, __, __ = self.request('POST', '/assets/v1/', data=dove2[1])
+        self.assertEqual(status, 401)
+        status, __, __ = self.request('POST', '/assets/v1/', headers=admin,
+                                      data=dict(dove2[1], type='foo'))
+        self.assertEqual(status, 400)
+        status, __, __ = self.request('POST', '/assets/v1/', headers=admin,
+                                      data=dict(dove2[1], name='_stats'))
+        self.assertEqual(status, 400)
+        
+        detailed = dict(dish2[1], details={'diameter': 10.0, 'radome': True})
+        status, __, body = self.request(
+            'POST', '/assets/v1/_bulk', headers=admin,
+            data=[dove1[1], dove2[1], detailed, dove2[1], {'name': 'f'}])
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [result['status'] for result in json.loads(body.decode('utf-8'))],
+            [409, 200, 200, 409, 400])
+        
+        self.assertEqual(self.get_json('/assets/v1/dish2'), detailed)
+        self.assertEqual(self.get_json('/assets/v1/'),
+                         [detailed, dove1[1], dove2[1]])
+        self.assertEqual(self.get_json('/assets/v1/_stats')['classes'],
+                         {'dish': 1, 'dove': 2, 'rapideye': 0, 'yagi': 0})
+        
+        status, __, __ = self.request('GET', '/assets/v1/nope')
+        self.assertEqual(status, 404)
+        status, __, __ = self.request('DELETE', '/assets/v1/')
+        self.assertEqual(status, 405)
+    
+    def test_redirects(self):
+        ''' Like flask, routes that end in a slash redirect there from
+        without it, keeping the query string.
+        '''
+        status, headers, __ = self.request('GET', '/assets/v1/ant',
+                                           query='class=dish',
+                                           headers={'Host': 'example.com'})
+        self.assertEqual(status, 308)
+        self.assertEqual(headers['location'],
+                         'http://example.com/assets/v1/ant/?class=dish')
+        
+        # Same as flask
+        res = plassets.app.test_client().get('/assets/v1/ant?class=dish')
+        self.assertEqual(res.status_code, 308)
+        self.assertEqual(res.headers['Location'],
+                         'http://localhost/assets/v1/ant/?class=dish')
+        
+        # For any method
+        status, headers, __ = self.request('POST', '/assets/v1',
+                                           headers={'X-User': 'admin'})
+        self.assertEqual(status, 308)
+        self.assertEqual(headers['location'], 'http://localhost/assets/v1/')
+        
+        status, __, __ = self.request('GET', '/assets/v1/sat/')
+        self.assertEqual(status, 404)
+    
+    def test_listings(self):
+        ''' Test filters, fields, pagination, streaming and etags.
+        '''
+        vecs = make_vectors()
+        with self.engine.begin() as conn:
+            conn.execute(Asset.__table__.insert(), [
+                {'name': vec[1]['name'], 'type': vec[1]['type'],
+                 'class': vec[1]['class'], 'details': None}
+                for vec in vecs
+            ])
+        dove1, dove2, rapideye1, rapideye2, dish1, dish2, yagi1, yagi2 = vecs
+        
+        self.assertEqual(self.get_json('/assets/v1/sat/dove'),
+                         [dove1[1], dove2[1]])
+        self.assertEqual(self.get_json('/assets/v1/', 'class=dish,yagi'),
+                         [dish1[1], dish2[1], yagi1[1], yagi2[1]])
+        self.assertEqual(self.get_json('/assets/v1/ant/', 'fields=name'),
+                         [{'name': 'dish1'}, {'name': 'dish2'},
+                          {'name': 'yagi1'}, {'name': 'yagi2'}])
+        status, __, __ = self.request('GET', '/assets/v1/', 'class=foo')
+        self.assertEqual(status, 400)
+        
+        status, headers, body = self.request('GET', '/assets/v1/sat',
+                                             'limit=3')
+        self.assertEqual(json.loads(body.decode('utf-8')),
+                         [dove1[1], dove2[1], rapideye1[1]])
+        self.assertEqual(
+            self.get_json('/assets/v1/sat',
+                          'limit=3&cursor=' + headers['x-next-cursor']),
+            [rapideye2[1]])
+        
+        # Make sure the batching gets exercised
+        self.app.stream_batch_size = 3
+        expected = [dish1[1], dish2[1], dove1[1], dove2[1], rapideye1[1],
+                    rapideye2[1], yagi1[1], yagi2[1]]
+        self.assertEqual(self.get_json('/assets/v1/', 'stream=1'), expected)
+        self.assertEqual(self.get_json('/assets/v1/', 'stream=1&limit=5'),
+                         expected[:5])
+        status, headers, body = self.request(
+            'GET', '/assets/v1/', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(headers['content-type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in
+                          body.decode('utf-8').splitlines()], expected)
+        
+        status, headers, __ = self.request('GET', '/assets/v1/')
+        status, __, body = self.request(
+            'GET', '/assets/v1/', headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+
 if __name__ == '__main__':
     unittest.main()